@@ -0,0 +1,88 @@
+"""
+Report the memory taken by each connected session, and by the pack index.
+Run from the folder holding `packs.zip`:
+
+    python bench_memory.py [nb_sessions ...]
+"""
+import asyncio
+import gc
+import json
+import logging
+import sys
+import tracemalloc
+
+from headless import FakeChannel
+from server import PACKSDB, MySSHSession
+
+# Sessions log when they start
+logging.disable(logging.INFO)
+
+
+async def bytes_per_session(nb_sessions, term_width=120, term_height=40):
+    channels = [FakeChannel(term_width, term_height) for _ in range(nb_sessions)]
+
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+
+    sessions = []
+    for chan in channels:
+        session = MySSHSession()
+        session.connection_made(chan)
+        session.session_started()
+        # Idle state, once debounced calls are done
+        session.run_pending()
+        sessions.append(session)
+
+    # Let the event loop drop the cancelled timers
+    await asyncio.sleep(0)
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return (after - before) / nb_sessions
+
+
+def deep_size(obj):
+    """
+    Return the size of `obj` and of all the objects it references
+    """
+    seen = set()
+    todo = [obj]
+    size = 0
+    while todo:
+        obj = todo.pop()
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        todo += gc.get_referents(obj)
+    return size
+
+
+def index_bytes():
+    """
+    Return the memory taken by the pack index, as decoded from JSON and as
+    loaded by PacksDB
+    """
+    with PACKSDB.f_zip.open("packsinfo.json") as f_in:
+        as_dicts = deep_size(json.load(f_in))
+    return as_dicts, deep_size(PACKSDB.index)
+
+
+async def main():
+    as_dicts, as_columns = index_bytes()
+    print(
+        f"Index of {len(PACKSDB.index)} packs: {as_dicts:.0f} bytes as dicts, "
+        f"{as_columns:.0f} bytes as columns"
+    )
+
+    for nb_sessions in [int(arg) for arg in sys.argv[1:]] or [1000, 10000]:
+        print(
+            f"{nb_sessions:>6} sessions: "
+            f"{await bytes_per_session(nb_sessions):8.0f} bytes per session"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
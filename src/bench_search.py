@@ -0,0 +1,108 @@
+"""
+Report the time taken to update the results of a search after each typed
+char, over the whole catalog. Run from the folder holding `packs.zip`:
+
+    python bench_search.py [--packs N ...] [term ...]
+
+Without terms, the words of the titles of the packs are typed. With `--packs`,
+the catalog is scaled to N packs (the packs of `packs.zip` being repeated), to
+see how searches scale with the size of the catalog.
+"""
+import argparse
+from array import array
+import asyncio
+import logging
+import time
+
+from headless import FakeChannel
+from pack_index import PackIndex
+from server import PACKSDB, MySSHSession
+
+# Sessions log when they start
+logging.disable(logging.INFO)
+
+
+def percentile(values, p):
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+async def keystroke_times(terms, term_width=120, term_height=40):
+    session = MySSHSession()
+    session.connection_made(FakeChannel(term_width, term_height))
+    session.session_started()
+
+    times = []
+    for term in terms:
+        session.data_received(b"/", None)
+        for char in term.encode():
+            start = time.perf_counter()
+            session.data_received(bytes((char,)), None)
+            # Do not wait for the user to pause typing
+            session.run_pending()
+            times.append(time.perf_counter() - start)
+        session.data_received(b"\x1b", None)
+
+    return sorted(times)
+
+
+def scale_catalog(packs, search_keys, nb_packs):
+    """
+    Replace the index of PACKSDB with one of `nb_packs` packs, repeating the
+    packs of `packs` (the index of `packs.zip`) and their `search_keys`
+    """
+    PACKSDB.index = PackIndex(
+        {
+            "id": f"{pos:032x}",
+            "title": packs.titles[pos % len(packs)],
+            "tags": packs.tags[pos % len(packs)],
+            "cover": packs.cover_ids[packs.covers[pos % len(packs)]],
+        }
+        for pos in range(nb_packs)
+    )
+    PACKSDB.search_keys = [search_keys[pos % len(packs)] for pos in range(nb_packs)]
+    PACKSDB.views = array("I", [0]) * nb_packs
+
+
+def default_terms():
+    # Only ASCII can be typed in a search
+    words = {
+        word.lower()
+        for pack in PACKSDB.index
+        for word in pack["title"].split()
+        if word.isascii()
+    }
+    return sorted(words)[:1000]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--packs",
+        type=int,
+        nargs="+",
+        help="catalog sizes to search (by default, the packs of packs.zip)",
+    )
+    parser.add_argument("terms", nargs="*")
+    args = parser.parse_args()
+
+    terms = args.terms or default_terms()
+    # Every size is scaled from the packs of packs.zip
+    zip_index, zip_keys = PACKSDB.index, PACKSDB.search_keys
+    nb_zip_packs = len(zip_index)
+    for nb_packs in args.packs or [nb_zip_packs]:
+        if nb_packs != len(PACKSDB.index):
+            scale_catalog(zip_index, zip_keys, nb_packs)
+        times = await keystroke_times(terms)
+        print(
+            f"{len(times)} keystrokes over {nb_packs} packs "
+            f"({nb_zip_packs} in packs.zip): "
+            + ", ".join(
+                f"p{int(p * 100)} {percentile(times, p) * 1000:.2f} ms"
+                for p in (0.5, 0.9, 0.99)
+            )
+            + f", max {times[-1] * 1000:.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,205 @@
+"""
+Compare the SSH transport profiles of `transport.py`. For each profile, a
+server is started on localhost, behind a proxy counting the bytes on the wire,
+and clients connect one after the other, move the cursor, and disconnect.
+Run from the folder holding `packs.zip`:
+
+    python bench_transport.py [--connections N] [--frames N] [profile ...]
+
+Reported, for each profile:
+
+- the handshake time, from connecting to the first frame (median)
+- the CPU time per connection, of the client and the server together
+- the bytes sent to the client per frame (after the handshake)
+
+Clients use the asyncssh defaults, which like OpenSSH only compress if the
+server requires it.
+"""
+import argparse
+import asyncio
+from collections import Counter
+import logging
+import statistics
+import time
+
+import asyncssh
+
+from server import MySSHServer, MySSHSession
+from transport import PROFILES, transport_options
+
+# Sessions log when they start
+logging.disable(logging.INFO)
+
+TERM_SIZE = (120, 40)
+
+# Bytes written by the sessions of the server
+written = Counter()
+
+
+class BenchSession(MySSHSession):
+    def render(self):
+        super().render()
+        written["frames"] += self.last_page_size
+
+
+class BenchServer(MySSHServer):
+    def begin_auth(self, _):
+        return False
+
+    def session_requested(self):
+        return BenchSession()
+
+
+class BenchClientSession(asyncssh.SSHClientSession):
+    def __init__(self):
+        self.received = 0
+        self._changed = asyncio.Event()
+        # Bytes written by the server before this session
+        self._written_before = written["frames"]
+
+    def data_received(self, data, datatype):
+        self.received += len(data)
+        self._changed.set()
+
+    async def next_frame(self):
+        """
+        Wait for a frame to be received whole
+        """
+        received = self.received
+        while (
+            self.received == received
+            or self.received < written["frames"] - self._written_before
+        ):
+            self._changed.clear()
+            await self._changed.wait()
+
+
+async def start_proxy(port, wire):
+    """
+    Forward connections to `port`, counting the bytes sent by the server in
+    `wire["down"]`, and by the client in `wire["up"]`. Return the proxy, and the
+    tasks handling its connections
+    """
+    handlers = set()
+
+    async def forward(reader, writer, direction):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                wire[direction] += len(data)
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def handle(client_reader, client_writer):
+        task = asyncio.current_task()
+        handlers.add(task)
+        try:
+            server_reader, server_writer = await asyncio.open_connection(
+                "127.0.0.1", port
+            )
+            await asyncio.gather(
+                forward(client_reader, server_writer, "up"),
+                forward(server_reader, client_writer, "down"),
+            )
+        finally:
+            handlers.discard(task)
+
+    proxy = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return proxy, handlers
+
+
+async def stop_proxy(proxy, handlers):
+    """
+    Close the proxy, and the connections it still forwards
+    """
+    proxy.close()
+    for task in handlers:
+        task.cancel()
+    await asyncio.gather(*handlers, return_exceptions=True)
+    await proxy.wait_closed()
+
+
+async def run_client(port, nb_frames, wire):
+    """
+    Connect, move the cursor `nb_frames` times, and return the handshake time
+    and the bytes sent by the server for the frames
+    """
+    start = time.perf_counter()
+    conn = await asyncssh.connect(
+        "127.0.0.1", port, username="bench", known_hosts=None
+    )
+    chan, session = await conn.create_session(
+        BenchClientSession, term_type="xterm", term_size=TERM_SIZE, encoding=None
+    )
+
+    # Sessions start with a frame
+    await session.next_frame()
+    handshake = time.perf_counter() - start
+
+    down = wire["down"]
+    for idx in range(nb_frames):
+        chan.write(b"\x1b[C" if idx % 2 == 0 else b"\x1b[D")
+        await session.next_frame()
+    frames_bytes = wire["down"] - down
+
+    conn.close()
+    await conn.wait_closed()
+    return handshake, frames_bytes
+
+
+async def bench_profile(profile, nb_connections, nb_frames):
+    server = await asyncssh.create_server(
+        BenchServer,
+        "127.0.0.1",
+        0,
+        server_host_keys=[asyncssh.generate_private_key("ssh-ed25519")],
+        encoding=None,
+        line_editor=False,
+        **transport_options(profile),
+    )
+    wire = Counter()
+    proxy, handlers = await start_proxy(server.get_port(), wire)
+    port = proxy.sockets[0].getsockname()[1]
+
+    # Warm the caches up
+    await run_client(port, nb_frames, wire)
+
+    handshakes = []
+    frames_bytes = 0
+    cpu = time.process_time()
+    for _ in range(nb_connections):
+        handshake, nb_bytes = await run_client(port, nb_frames, wire)
+        handshakes.append(handshake)
+        frames_bytes += nb_bytes
+    cpu = time.process_time() - cpu
+
+    await stop_proxy(proxy, handlers)
+    server.close()
+    await server.wait_closed()
+
+    print(
+        f"{profile:>12}: handshake {statistics.median(handshakes) * 1000:6.1f} ms, "
+        f"CPU {cpu / nb_connections * 1000:6.1f} ms per connection, "
+        f"{frames_bytes / (nb_connections * nb_frames):7.0f} bytes per frame"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--connections", type=int, default=20)
+    parser.add_argument("--frames", type=int, default=20)
+    parser.add_argument("profiles", nargs="*", default=list(PROFILES))
+    args = parser.parse_args()
+
+    for profile in args.profiles:
+        await bench_profile(profile, args.connections, args.frames)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
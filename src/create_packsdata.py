@@ -1,5 +1,6 @@
-from io import BytesIO
+from io import BytesIO, TextIOWrapper
 import json
+import os
 import subprocess
 import zipfile
 
@@ -7,17 +8,99 @@ from PIL import Image
 import anyio
 from signalstickers_client import StickersClient
 
-with open("packs.json", "r") as f:
-    packs = json.load(f)
+from sticker_cache import StickerCache
+from utils import thumb_id
 
-out_zip = zipfile.ZipFile("packs.zip", "a")
+# Number of packs downloaded at once
+FETCH_WORKERS = 4
 
+# Number of packs waiting between two steps of the pipeline
+PIPELINE_BUFFER = 8
 
-packs_info = []
+# Number of packs between the next one to write and the last one read: packs
+# downloaded out of order wait for the previous ones, to be written in the
+# order of the export
+REORDER_WINDOW = 32
 
-if "packsinfo.json" in out_zip.namelist():
-    with out_zip.open("packsinfo.json") as f_packinfo:
-        packs_info = json.load(f_packinfo)
+# Size of the chunks read from JSON files
+READ_CHUNK_SIZE = 64 * 1024
+
+# packsinfo.json and thumbs.json entries are written there as they are
+# produced, then copied to the zip
+INDEX_TMP_PATH = "packsinfo.jsonl.tmp"
+THUMBS_TMP_PATH = "thumbs.jsonl.tmp"
+
+
+def json_dumps(content):
+    return json.dumps(
+        content,
+        indent=None,
+        separators=(",", ":"),
+        ensure_ascii=True,
+        sort_keys=True,
+    )
+
+
+def iter_json(f_in):
+    """
+    Yield the items of the JSON array (or the (key, value) pairs of the JSON
+    object) in the text file `f_in`, without loading it whole
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def skip(chars):
+        """
+        Skip `chars` in the buffer, reading more of it if needed. Return the next
+        char, or "" at the end of the file
+        """
+        nonlocal buffer, pos, eof
+        while True:
+            while pos < len(buffer) and buffer[pos] in chars:
+                pos += 1
+            if pos < len(buffer) or eof:
+                return buffer[pos : pos + 1]
+            buffer, pos = f_in.read(READ_CHUNK_SIZE), 0
+            eof = not buffer
+
+    def decode():
+        """
+        Decode the value at `pos`, reading more of the file until it is whole
+        """
+        nonlocal buffer, pos, eof
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                # A value is followed by a delimiter: else, it may continue in
+                # the next chunk (eg. "1" of "1.5")
+                if eof or (end < len(buffer) and buffer[end] in " \t\r\n,:]}"):
+                    pos = end
+                    return value
+
+            chunk = f_in.read(READ_CHUNK_SIZE)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+    container = skip(" \t\r\n")
+    if not container or container not in "[{":
+        raise ValueError("Expected a JSON array or object")
+    closing = "]" if container == "[" else "}"
+    pos += 1
+
+    while skip(" \t\r\n,") != closing:
+        if container == "[":
+            yield decode()
+        else:
+            key = decode()
+            skip(" \t\r\n:")
+            yield key, decode()
 
 
 def make_asciiart(input_img):
@@ -69,26 +152,41 @@ def make_asciiart(input_img):
     return "\n".join(new_image)
 
 
-async def get_pack_thumbnails(pack_id, pack_key):
+async def get_pack_images(client, cache, pack_id, pack_key):
+    """
+    Return (cover, [(sticker_id, image), ...]) for a pack, from the cache if
+    possible
+    """
+    images = cache.get_pack(pack_id, pack_key)
 
-    async with StickersClient() as client:
+    if images is None:
         pack = await client.get_pack(pack_id, pack_key)
+        images = (
+            pack.cover.image_data,
+            [(sticker.id, sticker.image_data) for sticker in pack.stickers],
+        )
+        cache.put_pack(pack_id, pack_key, *images)
 
-    thumbs_list = []
+    return images
 
-    async with anyio.create_task_group() as tg:
-        for sticker in pack.stickers:
-            thumbs_list.append(make_asciiart(sticker.image_data))
 
-    return thumbs_list, make_asciiart(pack.cover.image_data)
+async def get_pack_thumbnails(client, cache, pack_id, pack_key):
 
+    cover, stickers = await get_pack_images(client, cache, pack_id, pack_key)
 
-for index, pack in enumerate(packs):
+    thumbs_list = []
 
-    if f'{pack["meta"]["id"]}.json' in out_zip.namelist():
-        continue
+    for _, image in stickers:
+        thumbs_list.append(make_asciiart(image))
 
-    print(".", end="", flush=True)
+    return thumbs_list, make_asciiart(cover)
+
+
+def make_pack_data(pack):
+    """
+    Return the packsinfo entry and the pack file content of an exported pack,
+    without their thumbnails
+    """
     pack_index = {
         "title": pack["manifest"]["title"],
         "id": pack["meta"]["id"],
@@ -111,52 +209,199 @@ for index, pack in enumerate(packs):
             if key in ["original", "animated", "nsfw"]:
                 pack_index[key] = pack["meta"][key]
 
-    try:
-        pack_out["thumbs"], pack_index["cover"] = anyio.run(
-            get_pack_thumbnails, pack["meta"]["id"], pack["meta"]["key"]
+    return pack_index, pack_out
+
+
+class PacksWriter:
+    """
+    Write packs to the zip as they come, and the packsinfo and thumbs entries
+    to temporary files.
+
+    thumbs.json holds the thumbnails of the covers, which the server keeps in
+    memory. Each pack holds the thumbnails of its stickers ("images", by id),
+    but the ones that are in thumbs.json already
+    """
+
+    def __init__(self, out_zip):
+        self.out_zip = out_zip
+        self.f_index = open(INDEX_TMP_PATH, "w")
+        self.f_thumbs = open(THUMBS_TMP_PATH, "w")
+        # Only the ids of the thumbnails are kept in memory
+        self.thumb_ids = set()
+
+        # Carry over the entries of the existing archive
+        cover_ids = set()
+        if "packsinfo.json" in out_zip.namelist():
+            with out_zip.open("packsinfo.json") as f_packinfo:
+                f_packinfo = TextIOWrapper(f_packinfo, encoding="utf-8")
+                for pack_index in iter_json(f_packinfo):
+                    cover_ids.add(pack_index["cover"])
+                    self.write_index(pack_index)
+
+        if "thumbs.json" in out_zip.namelist():
+            with out_zip.open("thumbs.json") as f_thumbs:
+                f_thumbs = TextIOWrapper(f_thumbs, encoding="utf-8")
+                for image_id, image in iter_json(f_thumbs):
+                    if image_id in cover_ids:
+                        self._write_thumb(image_id, image)
+
+    def write_index(self, pack_index):
+        self.f_index.write(json_dumps(pack_index) + "\n")
+
+    def add_thumb(self, image):
+        """
+        Add `image` to the thumbnails table, and return its id
+        """
+        image_id = thumb_id(image)
+        if image_id not in self.thumb_ids:
+            self._write_thumb(image_id, image)
+        return image_id
+
+    def _write_thumb(self, image_id, image):
+        self.thumb_ids.add(image_id)
+        self.f_thumbs.write(json_dumps([image_id, image]) + "\n")
+
+    def write_pack(self, pack_index, pack_out, pack_thumbs, pack_cover):
+        pack_index["cover"] = self.add_thumb(pack_cover)
+
+        pack_out["thumbs"] = []
+        pack_out["images"] = {}
+        for thumb in pack_thumbs:
+            image_id = thumb_id(thumb)
+            if image_id not in self.thumb_ids:
+                pack_out["images"][image_id] = thumb
+            pack_out["thumbs"].append(image_id)
+
+        self.out_zip.writestr(
+            zipfile.ZipInfo(f'{pack_out["id"]}.json'),
+            json_dumps(pack_out),
+            zipfile.ZIP_DEFLATED,
+            9,
         )
-    except:
-        # Probably 403 in a sticker pack
-        continue
-
-    out_zip.writestr(
-        zipfile.ZipInfo(f'{pack["meta"]["id"]}.json'),
-        json.dumps(
-            pack_out,
-            indent=None,
-            separators=(",", ":"),
-            ensure_ascii=True,
-            sort_keys=True,
-        ),
-        zipfile.ZIP_DEFLATED,
-        9,
-    )
+        self.write_index(pack_index)
 
-    packs_info.append(pack_index)
+    def close(self):
+        self.f_index.close()
+        self.f_thumbs.close()
 
 
-out_zip.close()
+async def build(out_zip, cache):
+    existing = set(out_zip.namelist())
+    writer = PacksWriter(out_zip)
 
+    send_packs, receive_packs = anyio.create_memory_object_stream(PIPELINE_BUFFER)
+    send_done, receive_done = anyio.create_memory_object_stream(PIPELINE_BUFFER)
+    window = anyio.create_semaphore(REORDER_WINDOW)
 
-# Remove packinfos
-try:
-    subprocess.run(["zip", "-d", "packs.zip", "packsinfo.json"])
-except:
-    pass
+    async def read_packs():
+        """
+        Stream the packs of the export that are not in the archive yet, with
+        their position in the export
+        """
+        async with send_packs:
+            with open("packs.json", "r") as f:
+                seq = 0
+                for pack in iter_json(f):
+                    name = f'{pack["meta"]["id"]}.json'
+                    if name in existing:
+                        continue
+                    # Packs repeated in the export are only fetched once
+                    existing.add(name)
+                    await window.acquire()
+                    await send_packs.send((seq, make_pack_data(pack)))
+                    seq += 1
+
+    async def fetch_thumbnails(client, receive_packs, send_done):
+        async with receive_packs, send_done:
+            async for seq, (pack_index, pack_out) in receive_packs:
+                try:
+                    thumbs = await get_pack_thumbnails(
+                        client, cache, pack_out["id"], pack_out["key"]
+                    )
+                except Exception:
+                    # Probably 403 in a sticker pack: skipped, but the packs
+                    # after it must not wait for it
+                    await send_done.send((seq, None))
+                    continue
+                await send_done.send((seq, (pack_index, pack_out) + thumbs))
+
+    async def write_packs():
+        """
+        Write the packs in the order of the export, so that rebuilds keep the
+        order of the catalog
+        """
+        # Packs fetched before the ones preceding them, by position
+        pending = {}
+        next_seq = 0
+        async with receive_done:
+            async for seq, pack_data in receive_done:
+                pending[seq] = pack_data
+                while next_seq in pending:
+                    pack_data = pending.pop(next_seq)
+                    next_seq += 1
+                    await window.release()
+                    if pack_data is not None:
+                        print(".", end="", flush=True)
+                        writer.write_pack(*pack_data)
 
-out_zip = zipfile.ZipFile("packs.zip", "a")
+    async with StickersClient() as client:
+        async with anyio.create_task_group() as tg:
+            await tg.spawn(read_packs)
+            for _ in range(FETCH_WORKERS):
+                await tg.spawn(
+                    fetch_thumbnails, client, receive_packs.clone(), send_done.clone()
+                )
+            await tg.spawn(write_packs)
+            # Only the clones are used by the workers
+            await receive_packs.aclose()
+            await send_done.aclose()
+
+    writer.close()
+
+
+def copy_entries(out_zip, name, tmp_path, opening, closing, make_entry):
+    """
+    Write the JSON lines of `tmp_path` to `name` in the zip, as a JSON array or
+    object, one line at a time
+    """
+    with out_zip.open(name, "w") as f_out, open(tmp_path) as f_in:
+        f_out.write(opening)
+        for idx, line in enumerate(f_in):
+            if idx:
+                f_out.write(b",")
+            f_out.write(make_entry(line.rstrip("\n")).encode())
+        f_out.write(closing)
+    os.remove(tmp_path)
+
+
+def main():
+    out_zip = zipfile.ZipFile("packs.zip", "a")
+    anyio.run(build, out_zip, StickerCache())
+    out_zip.close()
+
+    # Remove packinfos and thumbs table
+    try:
+        subprocess.run(["zip", "-d", "packs.zip", "packsinfo.json", "thumbs.json"])
+    except:
+        pass
+
+    out_zip = zipfile.ZipFile(
+        "packs.zip", "a", compression=zipfile.ZIP_DEFLATED, compresslevel=9
+    )
+
+    copy_entries(out_zip, "packsinfo.json", INDEX_TMP_PATH, b"[", b"]", str)
+    copy_entries(
+        out_zip,
+        "thumbs.json",
+        THUMBS_TMP_PATH,
+        b"{",
+        b"}",
+        # [id, image] -> "id":image
+        lambda line: line[1:-1].replace(",", ":", 1),
+    )
+
+    out_zip.close()
 
-out_zip.writestr(
-    zipfile.ZipInfo(f"packsinfo.json"),
-    json.dumps(
-        packs_info,
-        indent=None,
-        separators=(",", ":"),
-        ensure_ascii=True,
-        sort_keys=True,
-    ),
-    zipfile.ZIP_DEFLATED,
-    9,
-)
 
-out_zip.close()
+if __name__ == "__main__":
+    main()
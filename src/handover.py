@@ -0,0 +1,176 @@
+"""
+Restart the server without turning anyone away:
+
+    kill -USR2 <server pid>
+
+starts a new server process, which inherits the listening sockets. Once it has
+loaded the packs and is serving (it tells so through a pipe), this process
+stops accepting connections, and lets the connected sessions finish for up to
+`DRAIN_TIMEOUT` seconds before closing them and exiting. New users are served
+by the new process from the start, without waiting for it to load.
+
+If the new process fails to start, this one keeps serving.
+"""
+import asyncio
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+DRAIN_TIMEOUT = float(os.environ.get("SSH_DRAIN_TIMEOUT", 600))
+
+# Seconds the new process has to get ready
+READY_TIMEOUT = 120
+
+# Environment variables telling the new process what it inherits
+LISTEN_FD_ENV = "{}_LISTEN_FD"
+READY_FD_ENV = "SERVER_READY_FD"
+
+
+def listen_socket(name, port):
+    """
+    Return the listening socket `name` (eg. "SSH"), inherited from the previous
+    process if any, else bound to `port`
+    """
+    fd = os.environ.pop(LISTEN_FD_ENV.format(name), None)
+    if fd is not None:
+        return socket.socket(fileno=int(fd))
+
+    try:
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    except OSError:
+        # No IPv6 on this host
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    else:
+        # Also accept IPv4 clients, seen as ::ffff:a.b.c.d
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("", port))
+    sock.listen()
+    return sock
+
+
+def notify_ready():
+    """
+    Tell the previous process, if any, that this one is serving
+    """
+    fd = os.environ.pop(READY_FD_ENV, None)
+    if fd is not None:
+        os.write(int(fd), b"1")
+        os.close(int(fd))
+
+
+class Handover:
+    """
+    Hand the `sockets` (by name) to a new process on SIGUSR2, then close the
+    `servers` and wait for the `connections` to be closed
+    """
+
+    def __init__(
+        self,
+        loop,
+        servers,
+        sockets,
+        connections,
+        before_restart=None,
+        restart_failed=None,
+    ):
+        self._loop = loop
+        self._servers = servers
+        self._sockets = sockets
+        self._connections = connections
+        # Called before the new process is started, and if it fails to start
+        self._before_restart = before_restart
+        self._restart_failed = restart_failed
+        self.running = False
+
+    def install(self):
+        self._loop.add_signal_handler(signal.SIGUSR2, self.start)
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        try:
+            if self._before_restart is not None:
+                self._before_restart()
+            ready = await self._spawn()
+        except Exception:
+            logging.exception("Could not start the new server")
+            ready = False
+
+        if not ready:
+            logging.error("The new server is not ready: keep serving")
+            self.running = False
+            if self._restart_failed is not None:
+                self._restart_failed()
+            return
+
+        logging.info(
+            "New server ready, draining %d connections", len(self._connections)
+        )
+        for server in self._servers:
+            server.close()
+
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while self._connections and time.monotonic() < deadline:
+            await asyncio.sleep(1)
+
+        if self._connections:
+            logging.info(
+                "Drain timeout: closing %d connections", len(self._connections)
+            )
+            for conn in list(self._connections):
+                conn.close()
+            # Let the connections be torn down
+            await asyncio.sleep(1)
+
+        logging.info("Drained, exiting")
+        self._loop.stop()
+
+    async def _spawn(self):
+        """
+        Start the new process, and return whether it got ready
+        """
+        ready_r, ready_w = os.pipe()
+        env = dict(os.environ)
+        env[READY_FD_ENV] = str(ready_w)
+        for name, sock in self._sockets.items():
+            env[LISTEN_FD_ENV.format(name)] = str(sock.fileno())
+
+        fds = [ready_w] + [sock.fileno() for sock in self._sockets.values()]
+        try:
+            process = subprocess.Popen(
+                [sys.executable] + sys.argv, env=env, pass_fds=fds
+            )
+        finally:
+            # Only the new process may write: if it dies, reads get EOF
+            os.close(ready_w)
+
+        logging.info("Started the new server (pid %d)", process.pid)
+
+        ready = self._loop.create_future()
+
+        def on_readable():
+            if not ready.done():
+                ready.set_result(os.read(ready_r, 1) == b"1")
+
+        self._loop.add_reader(ready_r, on_readable)
+        try:
+            ready = await asyncio.wait_for(ready, READY_TIMEOUT)
+        except asyncio.TimeoutError:
+            ready = False
+        finally:
+            self._loop.remove_reader(ready_r)
+            os.close(ready_r)
+
+        if not ready:
+            process.kill()
+            await self._loop.run_in_executor(None, process.wait)
+        return ready
@@ -0,0 +1,43 @@
+"""
+Stand-in for the asyncssh channel, to drive `MySSHSession` without a client
+"""
+
+
+class FakeChannel:
+
+    __slots__ = ("term_size", "peername", "bytes_written", "frames", "exit_status")
+
+    def __init__(self, term_width=80, term_height=24, peername="127.0.0.1"):
+        self.term_size = (term_width, term_height, 0, 0)
+        self.peername = peername
+
+        # Output is counted, not kept
+        self.bytes_written = 0
+        self.frames = 0
+
+        self.exit_status = None
+
+    def get_terminal_size(self):
+        return self.term_size
+
+    def get_extra_info(self, name, default=None):
+        if name == "peername":
+            return (self.peername, 0)
+        return default
+
+    def get_write_buffer_size(self):
+        # Written instantly
+        return 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        self.frames += 1
+
+    def set_echo(self, echo):
+        pass
+
+    def set_line_mode(self, line_mode):
+        pass
+
+    def exit(self, status):
+        self.exit_status = status
@@ -0,0 +1,343 @@
+"""
+Plain-text HTTP version of the SSH server, for a quick look with `curl`:
+
+    curl localhost:8080/
+    curl localhost:8080/?page=2
+    curl "localhost:8080/search?q=cat"
+    curl localhost:8080/pack/<pack_id>
+    curl localhost:8080/metrics
+
+Pages are rendered with `SSHTemplate`, in ANSI colors for curl and plain text
+for the others (force it with `color=1` or `color=0`). Use `width` to set the
+number of columns (80 by default). Rendered pages are cached, and served with
+an ETag and gzip if asked for (the gzipped body has its own ETag). `/metrics`
+reports the SSH sessions by render quality.
+"""
+import asyncio
+from collections import OrderedDict
+import gzip
+import hashlib
+import logging
+import os
+import re
+from urllib.parse import parse_qs, quote_plus, unquote, urlsplit
+
+from link_quality import metrics
+from templates import ANSI_ESCAPE, SSHTemplate
+from utils import Pager, clean_search_term
+
+# Number of rendered pages to keep
+CACHE_SIZE = int(os.environ.get("HTTP_CACHE_SIZE", 512))
+
+# Rows of packs on a listing page
+ROWS_PER_PAGE = 4
+
+DEFAULT_WIDTH = 80
+MIN_WIDTH = 21
+MAX_WIDTH = 400
+
+# Seconds to wait for the client to send its request
+REQUEST_TIMEOUT = 10
+
+PACK_ID = re.compile(r"[0-9a-f]{32}")
+
+NOT_FOUND = b"Not found\n"
+
+STATUS_TEXT = {
+    200: "OK",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+}
+
+
+class NotFound(Exception):
+    pass
+
+
+class PageCache:
+    """
+    Rendered pages, by (path, search term, page, width, color). Entries are
+    [etag, body, gzipped body (compressed on first use)]. The gzipped body has
+    the ETag of the body, suffixed with "-gzip"
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._pages = OrderedDict()
+
+    def get(self, key):
+        """
+        Return the cache entry for `key`, or None
+        """
+        entry = self._pages.get(key)
+        if entry is not None:
+            self._pages.move_to_end(key)
+        return entry
+
+    def add(self, key, body):
+        """
+        Cache `body` for `key`, and return its entry
+        """
+        etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+        entry = self._pages[key] = [etag, body, None]
+        if len(self._pages) > self.size:
+            self._pages.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def gzipped(entry):
+        if entry[2] is None:
+            entry[2] = gzip.compress(entry[1])
+        return entry[2]
+
+    @staticmethod
+    def gzip_etag(entry):
+        return entry[0][:-1] + '-gzip"'
+
+
+class HTTPPages:
+    """
+    Render the pages served over HTTP
+    """
+
+    def __init__(self, packsdb):
+        self._packsdb = packsdb
+        self.cache = PageCache(CACHE_SIZE)
+
+    async def render(self, path, query, width, color):
+        """
+        Return the cache entry of a page, rendering it if needed
+        """
+        if path in ("/", "/search"):
+            term, page = _parse_search(query)
+        else:
+            term = page = None
+
+        key = (path, term, page, width, color)
+        entry = self.cache.get(key)
+        if entry is not None:
+            return entry
+
+        nb_per_row = max(int(width / 21), 1)
+        template = SSHTemplate.get(
+            term_width=width, term_height=0, nb_img_per_row=nb_per_row
+        )
+
+        if path in ("/", "/search"):
+            parts = self._listing(template, term, page, nb_per_row * ROWS_PER_PAGE)
+        elif path.startswith("/pack/"):
+            parts = self._details(template, await self._load(path[len("/pack/") :]))
+        else:
+            raise NotFound()
+
+        body = b"".join(parts)
+        return self.cache.add(key, body if color else ANSI_ESCAPE.sub(b"", body))
+
+    def _listing(self, template, term, page, page_size):
+        pager = Pager(page_size=page_size, packsdb_inst=self._packsdb)
+        parts = [template.header()[0], template.intro()[0]]
+
+        if term:
+            parts.append(template.searched_terms(term)[0])
+            pager.search(term)
+
+        pager.resize(page_size, (page - 1) * page_size)
+
+        parts.append(template.packs_grid(pager.content, self._packsdb.thumbs)[0])
+        parts.append(self._footer(pager, term))
+        return parts
+
+    def _footer(self, pager, term):
+        links = []
+        search = f"q={quote_plus(term)}&" if term else ""
+        base = "/search" if term else "/"
+        if pager.has_prev:
+            links.append(f"previous: {base}?{search}page={pager.page_idx}")
+        if pager.has_next:
+            links.append(f"next: {base}?{search}page={pager.page_idx + 2}")
+        links.append("details: /pack/<pack_id>")
+        return (" | ".join(links) + "\n").encode()
+
+    async def _load(self, pack_id):
+        if not PACK_ID.fullmatch(pack_id):
+            raise NotFound()
+        try:
+            return await self._packsdb.load(pack_id)
+        except KeyError:
+            raise NotFound()
+
+    def _details(self, template, pack):
+        return [
+            template.header()[0],
+            template.details(pack)[0],
+            template.thumbs_grid(pack["thumbs"], pack["images"])[0],
+        ]
+
+
+def _parse_search(query):
+    """
+    Return the search term (only with the chars that can be typed in the SSH
+    server) and the page number of a listing
+    """
+    term = clean_search_term(query.get("q", "")).strip()
+    try:
+        page = max(int(query.get("page", 1)), 1)
+    except ValueError:
+        page = 1
+    return term, page
+
+
+def _parse_width(query):
+    try:
+        width = int(query.get("width", DEFAULT_WIDTH))
+    except ValueError:
+        width = DEFAULT_WIDTH
+    return min(max(width, MIN_WIDTH), MAX_WIDTH)
+
+
+async def _read_request(reader):
+    """
+    Return the method, target and headers (lowercased names) of a request
+    """
+    request_line = await reader.readline()
+    method, target, _ = request_line.decode("latin-1").split(" ", 2)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    return method, target, headers
+
+
+def _accepts_gzip(headers):
+    """
+    Return whether the Accept-Encoding header allows gzip (eg. not with
+    "gzip;q=0")
+    """
+    qvalues = {}
+    for coding in headers.get("accept-encoding", "").split(","):
+        name, *params = coding.split(";")
+        qvalue = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[name.strip().lower()] = qvalue
+
+    qvalue = qvalues.get("gzip", qvalues.get("x-gzip", qvalues.get("*", 0.0)))
+    return qvalue > 0
+
+
+def _wants_color(query, headers):
+    if "color" in query:
+        return query["color"] == "1"
+    return headers.get("user-agent", "").startswith("curl/")
+
+
+def _response_head(status, headers=None, body=b""):
+    lines = [f"HTTP/1.1 {status} {STATUS_TEXT[status]}"]
+    headers = dict(headers or {})
+    if status != 304:
+        headers["Content-Length"] = str(len(body))
+    headers["Connection"] = "close"
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+async def handle_request(pages, reader, writer):
+    try:
+        try:
+            method, target, headers = await asyncio.wait_for(
+                _read_request(reader), REQUEST_TIMEOUT
+            )
+        except (ValueError, asyncio.TimeoutError):
+            writer.write(_response_head(400))
+            return
+
+        if method not in ("GET", "HEAD"):
+            writer.write(_response_head(405, {"Allow": "GET, HEAD"}))
+            return
+
+        url = urlsplit(target)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        if url.path == "/metrics":
+            body = metrics().encode()
+            writer.write(
+                _response_head(
+                    200,
+                    {
+                        "Content-Type": "text/plain; version=0.0.4",
+                        "Cache-Control": "no-store",
+                    },
+                    body,
+                )
+            )
+            if method == "GET":
+                writer.write(body)
+            return
+
+        try:
+            entry = await pages.render(
+                unquote(url.path),
+                query,
+                _parse_width(query),
+                _wants_color(query, headers),
+            )
+        except NotFound:
+            writer.write(_response_head(404, body=NOT_FOUND))
+            writer.write(NOT_FOUND)
+            return
+
+        resp_headers = {
+            "Content-Type": "text/plain; charset=utf-8",
+            "Vary": "Accept-Encoding",
+            "Cache-Control": "public, max-age=300",
+        }
+        use_gzip = _accepts_gzip(headers)
+        etag = PageCache.gzip_etag(entry) if use_gzip else entry[0]
+        resp_headers["ETag"] = etag
+
+        if headers.get("if-none-match") == etag:
+            writer.write(_response_head(304, resp_headers))
+            return
+
+        if use_gzip:
+            body = PageCache.gzipped(entry)
+            resp_headers["Content-Encoding"] = "gzip"
+        else:
+            body = entry[1]
+
+        writer.write(_response_head(200, resp_headers, body))
+        if method == "GET":
+            writer.write(body)
+    except Exception:
+        logging.exception("Error while serving HTTP request")
+    finally:
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+
+async def start_http_server(packsdb, port=None, sock=None):
+    """
+    Serve on `port`, or on the listening socket `sock`
+    """
+    pages = HTTPPages(packsdb)
+    return await asyncio.start_server(
+        lambda reader, writer: handle_request(pages, reader, writer),
+        None if sock else "",
+        port,
+        sock=sock,
+    )
@@ -0,0 +1,151 @@
+"""
+Follow how fast each client drains the frames written to it, and pick the
+render quality it can keep up with:
+
+- "full": thumbnails, in colors
+- "plain": thumbnails, without colors
+- "compact": titles only, without colors
+
+A client falls behind when written frames pile up in the channel buffer, which
+happens once its SSH window is used up: a slow link or a long round trip both
+do that. The drain rate of this backlog gives the time the client needs to
+catch up. Past `DEGRADE_LAG` seconds, the quality is lowered a step; after
+`RECOVER_DELAY` seconds without backlog, it is raised a step.
+"""
+from collections import Counter
+import os
+import time
+
+FULL = "full"
+PLAIN = "plain"
+COMPACT = "compact"
+
+# From the best quality to the lightest
+QUALITIES = (FULL, PLAIN, COMPACT)
+
+# Seconds of backlog after which the quality is lowered
+DEGRADE_LAG = float(os.environ.get("SSH_DEGRADE_LAG", 0.5))
+
+# Seconds without backlog after which the quality is raised
+RECOVER_DELAY = float(os.environ.get("SSH_RECOVER_DELAY", 5))
+
+# Weight of the last measure in the drain rate
+RATE_SMOOTHING = 0.3
+
+# Number of connected sessions, by quality
+SESSIONS_BY_QUALITY = Counter({quality: 0 for quality in QUALITIES})
+
+
+class LinkMonitor:
+
+    __slots__ = (
+        "_chan",
+        "quality",
+        "rendered",
+        "paused",
+        "rate",
+        "_buffered",
+        "_written_at",
+        "_caught_up_at",
+        "_changed_at",
+    )
+
+    def __init__(self, chan):
+        self._chan = chan
+        self.quality = FULL
+        SESSIONS_BY_QUALITY[FULL] += 1
+        # Quality of the last frame written
+        self.rendered = FULL
+
+        # The channel asked for writes to stop
+        self.paused = False
+        # Bytes drained per second, measured while there was a backlog
+        self.rate = None
+
+        # Bytes in the channel buffer after the last frame, and when
+        self._buffered = 0
+        self._written_at = time.monotonic()
+        # Last time no backlog was seen
+        self._caught_up_at = self._written_at
+        # Last time the quality changed
+        self._changed_at = self._written_at
+
+    def check(self):
+        """
+        Measure the link before a frame is written, and return the quality to
+        render it with
+        """
+        now = time.monotonic()
+        buffered = self._chan.get_write_buffer_size()
+
+        if buffered:
+            # The client was busy draining since the last frame: the drained
+            # bytes give its rate
+            elapsed = now - self._written_at
+            drained = self._buffered - buffered
+            if elapsed > 0 and drained > 0:
+                rate = drained / elapsed
+                self.rate = (
+                    rate
+                    if self.rate is None
+                    else RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * self.rate
+                )
+
+            # The frames already queued are not lighter: give the last change
+            # some time to take effect
+            lag = buffered / self.rate if self.rate else 0
+            if lag > DEGRADE_LAG and now - self._changed_at > DEGRADE_LAG:
+                self._step(1)
+            self._caught_up_at = now
+        elif now - self._caught_up_at > RECOVER_DELAY:
+            self._step(-1)
+
+        return self.quality
+
+    def written(self):
+        """
+        Note that a frame has been written
+        """
+        self.rendered = self.quality
+        self._buffered = self._chan.get_write_buffer_size()
+        self._written_at = time.monotonic()
+
+    def pause(self):
+        """
+        The channel buffer is full: the client is already behind
+        """
+        self.paused = True
+        self._step(1)
+
+    def resume(self):
+        self.paused = False
+
+    def close(self):
+        if self.quality is not None:
+            SESSIONS_BY_QUALITY[self.quality] -= 1
+            self.quality = None
+
+    def _step(self, direction):
+        """
+        Move the quality one step lighter (1) or better (-1), if possible
+        """
+        if self.quality is None:
+            # Closed
+            return
+
+        idx = QUALITIES.index(self.quality) + direction
+        if 0 <= idx < len(QUALITIES):
+            SESSIONS_BY_QUALITY[self.quality] -= 1
+            self.quality = QUALITIES[idx]
+            SESSIONS_BY_QUALITY[self.quality] += 1
+            self._changed_at = self._caught_up_at = time.monotonic()
+
+
+def metrics():
+    """
+    Return the number of sessions by quality, in the Prometheus text format
+    """
+    return "".join(
+        f'ssh_sessions{{quality="{quality}"}} {SESSIONS_BY_QUALITY[quality]}\n'
+        for quality in QUALITIES
+    )
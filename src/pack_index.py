@@ -0,0 +1,220 @@
+"""
+The index of all packs, kept as columns rather than as one dict per pack: a
+large catalog is held by every session and every worker, and dicts with the
+same keys over and over take most of its memory.
+
+Packs are read through `PackRecord` views, which behave like the dicts of
+`packsinfo.json` (`pack["title"]`, `pack.get("nsfw", False)`).
+
+Sort orders are permutations of the positions of the packs, computed once and
+shared by all sessions, along with the rank of each pack in them. Search
+results are taken from the permutation, or sorted by rank if they are few.
+"""
+from array import array
+import sys
+
+# Bits of the flags column
+FLAGS = {"original": 1, "animated": 2, "nsfw": 4}
+
+# Sort orders, by name: what they are shown as. "default" is the order of
+# packsinfo.json, where new packs are added at the end
+SORT_ORDERS = {
+    "default": "default",
+    "newest": "newest first",
+    "title": "title",
+    "views": "most viewed",
+}
+
+# Search results are taken from the precomputed order if they are more than
+# 1/FILTER_RATIO of the packs, and sorted otherwise
+FILTER_RATIO = 4
+
+_MISSING = object()
+
+
+class PackIndex:
+
+    __slots__ = (
+        "ids",
+        "titles",
+        "tags",
+        "flags",
+        "covers",
+        "cover_ids",
+        "_orders",
+        "_ranks",
+    )
+
+    def __init__(self, packs, cover_ref=None):
+        """
+        Build the index from the entries of `packsinfo.json`. `cover_ref`, if
+        given, maps the cover of each entry to its thumbnail id
+        """
+        self.ids = []
+        self.titles = []
+        # "" for packs without tags
+        self.tags = []
+        self.flags = array("B")
+        # Offsets in `cover_ids`, so that each thumbnail id is kept once
+        self.covers = array("I")
+        self.cover_ids = []
+
+        cover_offsets = {}
+        for pack in packs:
+            self.ids.append(sys.intern(pack["id"]))
+            self.titles.append(sys.intern(pack["title"]))
+            self.tags.append(sys.intern(pack.get("tags", "")))
+            self.flags.append(
+                sum(bit for name, bit in FLAGS.items() if pack.get(name, False))
+            )
+
+            # Interned like the keys of the thumbnails table, so that the id is
+            # not stored twice
+            cover = sys.intern(
+                pack["cover"] if cover_ref is None else cover_ref(pack["cover"])
+            )
+            offset = cover_offsets.get(cover)
+            if offset is None:
+                offset = cover_offsets[cover] = len(self.cover_ids)
+                self.cover_ids.append(cover)
+            self.covers.append(offset)
+
+        nb_packs = len(self.ids)
+        self._orders = {"default": range(nb_packs)}
+        self._ranks = {}
+        self.set_order("newest", array("I", range(nb_packs - 1, -1, -1)))
+        titles = sorted(range(nb_packs), key=lambda i: self.titles[i].casefold())
+        self.set_order("title", array("I", titles))
+        # Until views are counted
+        self.set_order("views", array("I", range(nb_packs)))
+
+    def set_order(self, name, order, ranks=None):
+        """
+        Set the positions of the packs sorted by `name`. `ranks` is computed if
+        not given
+        """
+        if ranks is None:
+            ranks = make_ranks(order)
+        self._orders[name] = order
+        self._ranks[name] = ranks
+
+    def ordered(self, name):
+        """
+        Return all the packs, sorted by `name`
+        """
+        return PackView(self, self._orders[name])
+
+    def sort(self, positions, name):
+        """
+        Return `positions` (in the default order) sorted by `name`
+        """
+        if name == "default":
+            return positions
+
+        order = self._orders[name]
+        if len(positions) * FILTER_RATIO < len(order):
+            # Few positions: sorting them is cheaper than going through all the
+            # packs
+            return sorted(positions, key=self._ranks[name].__getitem__)
+
+        selected = bytearray(len(order))
+        for pos in positions:
+            selected[pos] = 1
+        return array("I", [pos for pos in order if selected[pos]])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, pos):
+        if isinstance(pos, slice):
+            return PackView(self, range(len(self))[pos])
+        if pos < 0:
+            pos += len(self)
+        if not 0 <= pos < len(self):
+            raise IndexError("pack index out of range")
+        return PackRecord(self, pos)
+
+    def __iter__(self):
+        return (PackRecord(self, i) for i in range(len(self)))
+
+    def view(self, positions):
+        """
+        Return the packs at `positions`, as a sequence
+        """
+        return PackView(self, positions)
+
+
+def make_ranks(order):
+    """
+    Return the rank of each position in `order`
+    """
+    ranks = array("I", [0]) * len(order)
+    for rank, pos in enumerate(order):
+        ranks[pos] = rank
+    return ranks
+
+
+class PackView:
+    """
+    Some packs of an index (eg. search results, or a page), without copying
+    them
+    """
+
+    __slots__ = ("_index", "_positions")
+
+    def __init__(self, index, positions):
+        self._index = index
+        self._positions = positions
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __getitem__(self, pos):
+        if isinstance(pos, slice):
+            return PackView(self._index, self._positions[pos])
+        return PackRecord(self._index, self._positions[pos])
+
+    def __iter__(self):
+        return (PackRecord(self._index, i) for i in self._positions)
+
+
+class PackRecord:
+    """
+    Read-only view of a pack of the index, used as the dict it was built from
+    """
+
+    __slots__ = ("_index", "_pos")
+
+    def __init__(self, index, pos):
+        self._index = index
+        self._pos = pos
+
+    @property
+    def position(self):
+        """
+        Position of the pack in the index
+        """
+        return self._pos
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        index, pos = self._index, self._pos
+        if key == "id":
+            return index.ids[pos]
+        if key == "title":
+            return index.titles[pos]
+        if key == "cover":
+            return index.cover_ids[index.covers[pos]]
+        if key == "tags":
+            return index.tags[pos] or default
+        if key in FLAGS:
+            return True if index.flags[pos] & FLAGS[key] else default
+        return default
+
+    def __repr__(self):
+        return f"<PackRecord {self['id']} {self['title']!r}>"
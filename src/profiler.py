@@ -0,0 +1,169 @@
+"""
+Sample the running server on demand, to see where the time goes:
+
+    kill -USR1 <server pid>
+
+samples the stacks of the event loop thread for `PROFILE_SECONDS`, and
+measures the loop lag, ie. how late scheduled callbacks run. Stacks are written
+in the collapsed format, one `frame;frame;frame count` per line, ready for
+flamegraph.pl or speedscope, and a summary is logged.
+
+Samples are taken by a SIGPROF handler, every `SAMPLE_INTERVAL` seconds of CPU
+time of the process: the handler runs in the event loop thread, between two
+bytecodes, so it sees exactly what the loop is busy with (a sampling thread
+would mostly see the loop when it releases the GIL, ie. when it is idle).
+The event loop must run in the main thread. The handler only keeps the code
+objects of the stack, which are named when the profile is written, so that it
+takes little of the time it measures.
+
+Nothing runs until the signal is received.
+"""
+from collections import Counter
+import logging
+import os
+import signal
+import time
+
+PROFILE_SECONDS = float(os.environ.get("PROFILE_SECONDS", 10))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", ".")
+
+# Seconds of CPU time between two stack samples
+SAMPLE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.01))
+# Seconds between two loop lag measures
+LAG_INTERVAL = 0.01
+
+# Summary of the samples of the event loop thread: category -> frames, as
+# (folder, file, function), None matching anything
+CATEGORIES = {
+    "render": [(None, "server.py", "render")],
+    "create_thumbnail": [(None, "templates.py", "create_thumbnail")],
+    "PacksDB": [
+        (None, "utils.py", "get"),
+        (None, "utils.py", "load"),
+        (None, "utils.py", "_with_thumb_refs"),
+    ],
+    "search": [(None, "utils.py", "search")],
+    "asyncssh": [("asyncssh", None, None)],
+}
+
+
+def _code_name(code):
+    folder, filename = os.path.split(code.co_filename)
+    return f"{os.path.basename(folder)}/{filename}:{code.co_name}"
+
+
+def _frame_matches(name, patterns):
+    folder, _, name = name.partition("/")
+    filename, _, function = name.partition(":")
+    frame = (folder, filename, function)
+    return any(
+        all(expected in (None, actual) for expected, actual in zip(pattern, frame))
+        for pattern in patterns
+    )
+
+
+def _collapse(codes):
+    """
+    Return a stack of code objects, from the innermost, as `loop;a;b;c`
+    """
+    return ";".join(["loop"] + [_code_name(code) for code in reversed(codes)])
+
+
+class LoopProfiler:
+    def __init__(self, loop):
+        self._loop = loop
+        self.running = False
+
+        self._stacks = None
+        self._lags = None
+
+    def install(self):
+        self._loop.add_signal_handler(signal.SIGUSR1, self.start)
+
+    def start(self, seconds=None):
+        if self.running:
+            return
+
+        seconds = seconds or PROFILE_SECONDS
+
+        logging.info("Profiling for %s seconds", seconds)
+        self.running = True
+        self._stacks = Counter()
+        self._lags = []
+
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, SAMPLE_INTERVAL, SAMPLE_INTERVAL)
+
+        self._loop.call_soon(self._measure_lag, time.monotonic())
+        self._loop.call_later(seconds, self._finish)
+
+    def _measure_lag(self, expected):
+        if not self.running:
+            return
+
+        now = time.monotonic()
+        self._lags.append(now - expected)
+        self._loop.call_later(LAG_INTERVAL, self._measure_lag, now + LAG_INTERVAL)
+
+    def _sample(self, signum, frame):
+        """
+        SIGPROF handler, run in the main thread
+        """
+        codes = []
+        while frame is not None:
+            codes.append(frame.f_code)
+            frame = frame.f_back
+        self._stacks[tuple(codes)] += 1
+
+    def _finish(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        self.running = False
+
+        # Stacks of code objects can name the same stack (eg. functions of the
+        # same name in the same file)
+        stacks = Counter()
+        for codes, count in self._stacks.items():
+            stacks[_collapse(codes)] += count
+        self._stacks = stacks
+
+        path = os.path.join(
+            PROFILE_DIR, f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded"
+        )
+        with open(path, "w") as f_out:
+            for stack, count in self._stacks.most_common():
+                f_out.write(f"{stack} {count}\n")
+
+        logging.info("Profile written to %s. %s", path, self.summary())
+
+    def summary(self):
+        loop_samples = Counter()
+        total = 0
+        for stack, count in self._stacks.items():
+            frames = stack.split(";")
+            if frames[0] != "loop":
+                continue
+            total += count
+            for category, patterns in CATEGORIES.items():
+                if any(_frame_matches(frame, patterns) for frame in frames[1:]):
+                    loop_samples[category] += count
+
+        breakdown = ", ".join(
+            f"{category} {100 * count / total:.1f}%"
+            for category, count in loop_samples.most_common()
+        )
+
+        lags = sorted(self._lags)
+        if lags:
+            lag = (
+                f"p50 {lags[len(lags) // 2] * 1000:.1f}ms, "
+                f"p99 {lags[int(len(lags) * 0.99)] * 1000:.1f}ms, "
+                f"max {lags[-1] * 1000:.1f}ms"
+            )
+        else:
+            lag = "not measured"
+
+        return (
+            f"Loop: {total} samples of {SAMPLE_INTERVAL * 1000:g}ms of CPU "
+            f"({breakdown}). Loop lag: {lag}"
+        )
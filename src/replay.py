@@ -0,0 +1,127 @@
+"""
+Replay session traces recorded with `SSH_TRACES_DIR` (see `traces.py`), without
+any client, and report the time and bytes taken by each rendered frame.
+Run from the folder holding `packs.zip`:
+
+    python replay.py [--recorded-speed] trace.jsonl [trace.jsonl ...]
+
+By default, traces are replayed as fast as possible. With `--recorded-speed`,
+the delays between events are kept, so debounced redraws happen as they did.
+"""
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+
+from headless import FakeChannel
+from server import MySSHSession
+from traces import read_trace
+
+# Sessions log when they start
+logging.disable(logging.INFO)
+
+
+class TimedSession(MySSHSession):
+    """
+    A session recording the time and size of each frame it renders
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.frame_times = []
+        self.frame_bytes = []
+
+    def render(self):
+        bytes_before = self._chan.bytes_written
+        start = time.perf_counter()
+        super().render()
+        self.frame_times.append(time.perf_counter() - start)
+        self.frame_bytes.append(self._chan.bytes_written - bytes_before)
+
+
+async def replay(events, recorded_speed=False):
+    """
+    Play `events` on a new session, and return it. Events before the "start"
+    one are skipped
+    """
+    for idx, start_event in enumerate(events):
+        if start_event.get("event") == "start":
+            break
+    else:
+        raise ValueError("no start event, the trace is empty or truncated")
+    try:
+        width, height = start_event["width"], start_event["height"]
+    except KeyError:
+        raise ValueError("the start event has no terminal size") from None
+
+    chan = FakeChannel(width, height)
+    session = TimedSession()
+    session.connection_made(chan)
+    session.session_started()
+
+    start = time.monotonic()
+    last_t = start_event["t"]
+    for event in events[idx + 1 :]:
+        if recorded_speed:
+            await asyncio.sleep(max(event["t"] - (time.monotonic() - start), 0))
+        else:
+            # Fire what the recorded pause would have let fire
+            session.run_pending(idle=event["t"] - last_t)
+        last_t = event["t"]
+
+        if event["event"] == "key":
+            session.data_received(event["key"].encode("latin-1"), None)
+            if not recorded_speed:
+                await session.wait_loading()
+        elif event["event"] == "resize":
+            session.terminal_size_changed(event["width"], event["height"], 0, 0)
+        elif event["event"] == "end":
+            break
+
+        if chan.exit_status is not None:
+            break
+
+    session.run_pending()
+    return session
+
+
+def report(path, session):
+    times_ms = sorted(t * 1000 for t in session.frame_times)
+    if not times_ms:
+        print(f"{path}: no frame rendered")
+        return
+
+    def percentile(pct):
+        return times_ms[min(int(len(times_ms) * pct / 100), len(times_ms) - 1)]
+
+    print(
+        f"{path}: {len(times_ms)} frames, "
+        f"render ms p50={percentile(50):.3f} p90={percentile(90):.3f} "
+        f"p99={percentile(99):.3f} max={times_ms[-1]:.3f}, "
+        f"bytes/frame mean={statistics.mean(session.frame_bytes):.0f} "
+        f"max={max(session.frame_bytes)}"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("traces", nargs="+")
+    parser.add_argument(
+        "--recorded-speed",
+        action="store_true",
+        help="keep the delays between events instead of replaying at full speed",
+    )
+    args = parser.parse_args()
+
+    for path in args.traces:
+        try:
+            session = await replay(read_trace(path), args.recorded_speed)
+        except (OSError, ValueError) as exc:
+            print(f"{path}: can not be replayed: {exc}")
+            continue
+        report(path, session)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
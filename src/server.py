@@ -4,16 +4,40 @@ import getpass
 import json
 import logging
 import os
-import string
 import sys
 import zipfile
 
 import asyncssh
 
+from handover import Handover, listen_socket, notify_ready
+from http_server import start_http_server
+from link_quality import COMPACT, FULL, LinkMonitor
+from pack_index import SORT_ORDERS
+from profiler import LoopProfiler
 from templates import SSHColors, SSHTemplate
-from utils import PacksDB, Pager, get_random_password
+from traces import TraceRecorder
+from transport import transport_options
+from utils import (
+    SEARCH_MAX_LENGTH,
+    Debouncer,
+    PacksDB,
+    Pager,
+    get_random_password,
+    printable,
+)
+
+RETURN = ord("\r")
+BACKSPACES = b"\x7f\x08"
 
-printable = string.ascii_letters + string.digits + string.punctuation + " "
+CLEAR_SCREEN = (
+    # Clear screen
+    b"\033[1J"
+    # Move cursor to top left
+    b"\033[1;1H"
+)
+SEARCH_PROMPT = (
+    SSHColors.BOLD + "Search" + SSHColors.ENDC + " (press Return to browse results): "
+).encode()
 
 
 logging.basicConfig(
@@ -26,34 +50,54 @@ asyncssh.set_log_level("WARNING")
 
 PACKSDB = PacksDB("packs.zip")
 
+# Seconds to wait for a burst of terminal resizes (eg. a window being dragged)
+# to settle before redrawing
+RESIZE_DEBOUNCE = 0.1
+
+# Seconds the cursor has to stay on a pack before the pack, and the next page,
+# are prepared in the background
+PREFETCH_DELAY = 0.3
+
+# Seconds to wait after a char is typed in a search before showing its results
+SEARCH_DEBOUNCE = 0.15
+
 key_actions = {
     # Up
-    "\x1b[A": "up",
-    "z": "up",
-    "w": "up",
+    b"\x1b[A": "up",
+    b"z": "up",
+    b"w": "up",
     # Down
-    "\x1b[B": "down",
-    "s": "down",
+    b"\x1b[B": "down",
+    b"s": "down",
     # Right
-    "\x1b[C": "right",
-    "d": "right",
+    b"\x1b[C": "right",
+    b"d": "right",
     # Left
-    "\x1b[D": "left",
-    "q": "left",
-    "a": "left",
+    b"\x1b[D": "left",
+    b"q": "left",
+    b"a": "left",
     # Controls
-    "/": "search",
-    "h": "help",
-    "\x1b": "escape",
-    "\x0d": "return",
-    "\x03": "exit",
-    "\x04": "exit",
-    "\x1a": "exit",
+    b"/": "search",
+    b"h": "help",
+    b"o": "sort",
+    b"\x1b": "escape",
+    b"\x0d": "return",
+    b"\x03": "exit",
+    b"\x04": "exit",
+    b"\x1a": "exit",
 }
 
 
+# Connections to this process, closed before it exits
+CONNECTIONS = set()
+
+
 def log(message, conn_info):
-    logging.info("[%s] %s", conn_info.get_extra_info("peername")[0], message)
+    host = conn_info.get_extra_info("peername")[0]
+    # IPv4 clients of the IPv6 listening socket
+    if host.startswith("::ffff:"):
+        host = host[len("::ffff:") :]
+    logging.info("[%s] %s", host, message)
 
 
 class MySSHSession(asyncssh.SSHServerSession):
@@ -76,6 +120,10 @@ class MySSHSession(asyncssh.SSHServerSession):
         # Pack details have to be displayed
         # This will use the pack index stored in self.cursor_pack
         self.show_pack_details = False
+        # The pack whose details are displayed
+        self.details_pack = None
+        # Task loading details_pack
+        self._pack_loading = None
 
         # The Pager for this client
         self.pager = None
@@ -84,202 +132,394 @@ class MySSHSession(asyncssh.SSHServerSession):
         self.search_mode = None
         # Hold the term searched by the user
         self.search_term = None
+        # Hold the search being typed
+        self.search_input = None
 
         # Client info
         self.term_height = None
         self.term_width = None
         self.pack_viewed = 0
 
+        # Redraw once the terminal has stopped being resized
+        self._resize_debouncer = Debouncer(RESIZE_DEBOUNCE, self._apply_resize)
+
+        # Prepare what is likely to be displayed next, once the cursor has
+        # stopped moving
+        self._prefetch_debouncer = Debouncer(PREFETCH_DELAY, self._prefetch)
+        # Id of the pack being prefetched
+        self._prefetched_id = None
+
+        # Show search results once the user pauses typing
+        self._search_debouncer = Debouncer(SEARCH_DEBOUNCE, self._apply_search)
+
+        # Record of the user inputs, if enabled
+        self._trace = TraceRecorder.create()
+
+        # Render quality the client can keep up with
+        self._link = None
+        # A frame was skipped while the channel was paused
+        self._frame_pending = False
+
         # If False, the app has just launched. Else, we can safely clear
         # it while writing to stdout
         self.can_clear_term = False
 
     def connection_made(self, chan):
         self._chan = chan
+        self._link = LinkMonitor(chan)
 
     def session_started(self):
         self.term_width, self.term_height, _, _ = self._chan.get_terminal_size()
+        self._layout()
+
+        if self._trace is not None:
+            self._trace.record("start", width=self.term_width, height=self.term_height)
 
-        self.nb_packs_per_row = int(self.term_width / 21)
+        self.pager = Pager(page_size=self._page_size(), packsdb_inst=PACKSDB)
 
-        self.template = SSHTemplate(
+        self._unset_search_mode()
+        self.render()
+        log("Sessions started", self._chan)
+
+    def _layout(self):
+        """
+        Compute everything depending on the terminal size
+        """
+        self.nb_packs_per_row = max(int(self.term_width / 21), 1)
+
+        self.template = SSHTemplate.get(
             term_width=self.term_width,
             term_height=self.term_height,
             nb_img_per_row=self.nb_packs_per_row,
+            color=self._link.quality == FULL,
         )
 
+    def _page_size(self):
+        """
+        Return the number of packs fitting in the terminal
+        """
         # A thumbnails with name takes 13 lines
-        # 10 is hardcoded (size of SSHTemplate.header + SSHTemplate.intro)
-        page_size = int((self.term_height - 10) / 13) * self.nb_packs_per_row
-        self.pager = Pager(page_size=page_size, packsdb_inst=PACKSDB)
+        # 10 is hardcoded (size of SSHTemplate.header + SSHTemplate.intro), plus
+        # 6 for SSHTemplate.searched_terms when searching
+        offset = 16 if self.search_term else 10
+        nb_rows = max(int((self.term_height - offset) / 13), 1)
+        return nb_rows * self.nb_packs_per_row
 
-        self._unset_search_mode()
+    def terminal_size_changed(self, width, height, pixwidth, pixheight):
+        self.term_width, self.term_height = width, height
+
+        # Called before session_started when the pty is requested
+        if self.pager is None:
+            return
+
+        if self._trace is not None:
+            self._trace.record("resize", width=width, height=height)
+
+        self._resize_debouncer()
+
+    def _apply_resize(self):
+        """
+        Re-layout for the new terminal size, keeping the cursor on the same pack
+        """
+        position = self.pager.position(self.cursor_pack)
+        self._layout()
+        self.cursor_pack = self.pager.resize(self._page_size(), position)
         self.render()
-        log("Sessions started", self._chan)
+
+    def run_pending(self, idle=None):
+        """
+        Run debounced redraws now instead of waiting for them (used by the
+        replay tool). If `idle` is given, only run the ones that would have
+        fired after `idle` seconds without input
+        """
+        self._resize_debouncer.flush(idle)
+        self._search_debouncer.flush(idle)
+        self._prefetch_debouncer.flush(idle)
+
+    async def wait_loading(self):
+        """
+        Wait for the pack being opened to be displayed, if any (used by the
+        replay tool)
+        """
+        if self._pack_loading is not None:
+            await asyncio.wait([self._pack_loading])
 
     def clear_screen(self):
         """
         Clear term content and put the cursor to top left
         """
-        # Clear screen
-        self._chan.write("\033[1J")
-        # Move cursor to top left
-        self._chan.write("\033[1;1H")
+        self._chan.write(CLEAR_SCREEN)
 
     def render(self):
-        def _write(content):
+        def _write(parts):
             """
-            Write `content` to client stdout
+            Write the frame made of `parts` to client stdout
             """
 
             if self.can_clear_term:
-                self.clear_screen()
+                parts.insert(0, CLEAR_SCREEN)
             else:
                 self.can_clear_term = True
 
+            content = b"".join(parts)
             self.last_page_size = len(content)
             self._chan.write(content)
+            self._link.written()
 
-        offset = 0
-        outstr = ""
-
-        def _draw_packs():
-
-            packs_str = ""
-            packs_thumbs_list = []
-
-            for idx, pack in enumerate(self.pager.content):
-                packs_thumbs_list.append(
-                    self.template.create_thumbnail(
-                        pack["cover"],
-                        title=pack["title"],
-                        selected=idx == self.cursor_pack,
-                        original=pack.get("original", False),
-                        animated=pack.get("animated", False),
-                        nsfw=pack.get("nsfw", False),
-                    ),
-                )
-
-            for i in range(0, len(packs_thumbs_list), self.nb_packs_per_row):
-                row = self.template.make_thumbnails_row(
-                    packs_thumbs_list[i : i + self.nb_packs_per_row],
-                    12,  # height of a thumb with title
-                )
-                packs_str += row
-                packs_str += "\n"
-
-            return packs_str, packs_str.count("\n")
-
-        def _draw_pack_details_thumbs():
-            thumbs_str = ""
-            thumbs_list = []
-
-            thumbs_list = [
-                self.template.create_thumbnail(img) for img in self.pager.content
-            ]
+        # The client has not read the previous frames yet: only draw the last
+        # one, once it has
+        if self._link.paused:
+            self._frame_pending = True
+            return
+        self._frame_pending = False
 
-            for i in range(0, len(thumbs_list), self.nb_packs_per_row):
-                row = self.template.make_thumbnails_row(
-                    thumbs_list[i : i + self.nb_packs_per_row],
-                    10,  # height of a thumb without title
-                )
-                thumbs_str += row
-                thumbs_str += "\n"
+        quality = self._link.check()
+        if quality != self._link.rendered:
+            log(f"Render quality: {quality}", self._chan)
+            self._layout()
 
-            return thumbs_str, thumbs_str.count("\n")
+        # Frame fragments, joined once written
+        parts = []
+        offset = 0
 
         # Render header
         header, off_add = self.template.header()
         offset += off_add
-        outstr += header
+        parts.append(header)
 
         # Render help page
         if self.show_help:
             help, off_add = self.template.help()
             offset += off_add
-            outstr += help
-            outstr += self.template.pad(offset)
-            _write(outstr)
+            parts.append(help)
+            parts.append(self.template.pad(offset))
+            _write(parts)
             return
 
         # Render pack details page
         if self.show_pack_details:
-            pack = PACKSDB.get(self.pager.content[self.cursor_pack]["id"])
+            pack = self.details_pack
+
+            if pack is None:
+                # Still loading
+                loading, off_add = self.template.loading()
+                parts.append(loading)
+                offset += off_add
+                parts.append(self.template.pad(offset))
+                _write(parts)
+                return
+
             details_rendered, off_add = self.template.details(pack=pack)
-            outstr += details_rendered
+            parts.append(details_rendered)
             offset += off_add
 
             # Set the pager for this pack
             self.pager.details(pack)
 
-            packs, off_add = _draw_pack_details_thumbs()
-            outstr += packs
-            offset += off_add
+            if quality != COMPACT:
+                packs, off_add = self.template.thumbs_grid(
+                    self.pager.content, pack["images"]
+                )
+                parts.append(packs)
+                offset += off_add
 
-            outstr += self.template.pad(offset)
-            _write(outstr)
+            parts.append(self.template.pad(offset))
+            _write(parts)
             return
 
         # Render intro
-        intro, off_add = self.template.intro()
-        outstr += intro
+        intro, off_add = self.template.intro(SORT_ORDERS[self.pager.sort_order])
+        parts.append(intro)
         offset += off_add
 
         # Render searched term text
         if self.search_term:
             st, off_add = self.template.searched_terms(self.search_term)
-            outstr += st
+            parts.append(st)
             offset += off_add
-            if not self.pager.search_mode:
-                # Initialize the page_size for
-                self.pager.page_size = (
-                    int((self.term_height - offset) / 13) * self.nb_packs_per_row
-                )
-                self.pager.search(term=self.search_term)
 
-        packs, off_add = _draw_packs()
-        outstr += packs
+        if quality == COMPACT:
+            packs, off_add = self.template.packs_list(
+                self.pager.content, self.cursor_pack
+            )
+        else:
+            packs, off_add = self.template.packs_grid(
+                self.pager.content, PACKSDB.thumbs, self.cursor_pack
+            )
+        parts.append(packs)
         offset += off_add
 
         # Add padding at the bottom if needed
-        outstr += self.template.pad(offset)
+        parts.append(self.template.pad(offset))
+
+        # Keep showing the search being typed
+        if self.search_mode:
+            parts.append(SEARCH_PROMPT)
+            parts.append(bytes(self.search_input))
 
         # Write rendered output
-        _write(outstr)
+        _write(parts)
+
+        self._prefetch_debouncer()
+
+    def _prefetch(self):
+        """
+        Load the pack under the cursor, and render the covers of the next page,
+        so that Return and next page are fast
+        """
+        if self.show_help or self.show_pack_details or not len(self.pager):
+            return
+
+        pack_id = self.pager.content[self.cursor_pack]["id"]
+        if pack_id != self._prefetched_id:
+            self._cancel_prefetch()
+            # Only remembered if counted, to be cancelled
+            if PACKSDB.prefetch(pack_id):
+                self._prefetched_id = pack_id
+
+        # Fill the thumbnails cache
+        if self._link.quality != COMPACT:
+            self.template.packs_grid(self.pager.peek_next(), PACKSDB.thumbs)
+
+    def _cancel_prefetch(self):
+        self._prefetch_debouncer.cancel()
+        if self._prefetched_id is not None:
+            PACKSDB.cancel_prefetch(self._prefetched_id)
+            self._prefetched_id = None
+
+    def _open_pack(self, pack_id):
+        """
+        Show the details of a pack. The pack is loaded without blocking the
+        event loop, a placeholder being shown meanwhile
+        """
+        if pack_id == self._prefetched_id:
+            # The load of the pack takes the prefetch over
+            self._prefetch_debouncer.cancel()
+            self._prefetched_id = None
+        else:
+            self._cancel_prefetch()
+        self.show_pack_details = True
+
+        self.details_pack = PACKSDB.cached(pack_id)
+        if self.details_pack is None:
+            self._pack_loading = asyncio.ensure_future(self._load_pack(pack_id))
+
+        self.render()
+
+    async def _load_pack(self, pack_id):
+        try:
+            pack = await PACKSDB.load(pack_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Error while loading pack %s", pack_id)
+            self._pack_loading = None
+            self._close_pack()
+        else:
+            self._pack_loading = None
+            self.details_pack = pack
+
+        self.render()
+
+    def _close_pack(self):
+        """
+        Exit pack details
+        """
+        if self._pack_loading is not None:
+            self._pack_loading.cancel()
+            self._pack_loading = None
+
+        self.show_pack_details = False
+        self.details_pack = None
+        self.pager.exit_details()
 
     def _set_search_mode(self):
-        self._chan.write(
-            SSHColors.BOLD + "Search" + SSHColors.ENDC + " (press Return to validate): "
-        )
-        self._chan.set_echo(True)
-        self._chan.set_line_mode(True)
+        self._chan.write(SEARCH_PROMPT)
+        self.search_input = bytearray()
         self.search_mode = True
 
     def _unset_search_mode(self):
-        self._chan.set_echo(False)
-        self._chan.set_line_mode(False)
+        self._search_debouncer.cancel()
+        self.search_input = None
         self.search_mode = False
 
+    def _search_input_received(self, data):
+        """
+        Edit the search line. The channel is in binary mode, so the line editing
+        and echo are done here. Results are updated as the user types
+        """
+        # Ignore arrows and other escape sequences
+        if data.startswith(b"\x1b"):
+            return
+
+        for char in data:
+            if char == RETURN:
+                # Stop typing, and browse the results
+                self._search_debouncer.cancel()
+                self._apply_search(render=False)
+                self.pager.validate_search()
+                if self._trace is not None:
+                    self._trace.record("search", term=self.search_term or "")
+                self._unset_search_mode()
+                self.render()
+                return
+
+            if char in BACKSPACES:
+                if self.search_input:
+                    del self.search_input[-1]
+                    self._chan.write(b"\b \b")
+                    self._search_debouncer()
+            elif char in printable and len(self.search_input) < SEARCH_MAX_LENGTH:
+                self.search_input.append(char)
+                self._chan.write(bytes((char,)))
+                self._search_debouncer()
+
+    def _apply_search(self, render=True):
+        """
+        Show the results for the search being typed
+        """
+        term = self.search_input.decode()
+        self.cursor_pack = 0
+
+        if term.strip():
+            self.search_term = term
+            self.pager.page_size = self._page_size()
+            self.pager.search(term=term)
+        elif self.search_term:
+            self.search_term = None
+            self.pager.page_size = self._page_size()
+            self.pager.exit_search()
+
+        if render:
+            self.render()
+
+    def pause_writing(self):
+        self._link.pause()
+
+    def resume_writing(self):
+        self._link.resume()
+        if self._frame_pending:
+            self.render()
+
     def shell_requested(self):
         return True
 
     def data_received(self, data, datatype):
 
+        if self._trace is not None:
+            self._trace.key(data)
+
         # Unknown command
         if data not in key_actions and not self.search_mode:
             return
 
-        if self.search_mode:
-            # Called after validation of the search.
-            self.search_term = "".join(filter(lambda c: c in printable, data))
-            self._unset_search_mode()
-            self.cursor_pack = 0
-            self.render()
-
+        if key_actions.get(data) == "exit":
+            self.eof_received()
             return
 
-        if key_actions[data] == "exit":
-            self.eof_received()
+        if self.search_mode and data != b"\x1b":
+            self._search_input_received(data)
+            return
 
         if key_actions[data] == "escape":
             self._unset_search_mode()
@@ -289,24 +529,23 @@ class MySSHSession(asyncssh.SSHServerSession):
                 self.search_term = None
                 self.cursor_pack = 0
                 # Reset page size
-                # A thumbnails with name takes 13 lines
-                # 10 is hardcoded (size of SSHTemplate.header + SSHTemplate.intro)
-                self.pager.page_size = (
-                    int((self.term_height - 10) / 13) * self.nb_packs_per_row
-                )
+                self.pager.page_size = self._page_size()
                 self.pager.exit_search()
 
             if self.show_pack_details:
-                self.show_pack_details = False
-                self.pager.exit_details()
+                self._close_pack()
 
             self.render()
             return
 
         if key_actions[data] == "return":
-            self.show_pack_details = True
-            self.render()
+            # Nothing to open (empty search results), or already opened
+            if self.show_pack_details or not len(self.pager):
+                return
+            pack = self.pager.content[self.cursor_pack]
+            self._open_pack(pack["id"])
             self.pack_viewed += 1  # for stats
+            PACKSDB.record_view(pack)
             return
 
         if key_actions[data] == "help":
@@ -369,11 +608,41 @@ class MySSHSession(asyncssh.SSHServerSession):
             self._set_search_mode()
             return
 
+        if key_actions[data] == "sort":
+            orders = list(SORT_ORDERS)
+            next_order = orders[(orders.index(self.pager.sort_order) + 1) % len(orders)]
+            self.pager.sort(next_order)
+            self.cursor_pack = 0
+            self.render()
+
     def eof_received(self):
+        self._teardown()
         self.clear_screen()
         log(f"Client disconnected. {self.pack_viewed} pack viewed.", self._chan)
         self._chan.exit(0)
 
+    def connection_lost(self, exc):
+        self._teardown()
+
+    def _teardown(self):
+        """
+        Stop everything scheduled by the session, nothing must render once the
+        channel is closed
+        """
+        self._resize_debouncer.cancel()
+        self._search_debouncer.cancel()
+        self._cancel_prefetch()
+        if self._pack_loading is not None:
+            self._pack_loading.cancel()
+            self._pack_loading = None
+        self._close_trace()
+        self._link.close()
+
+    def _close_trace(self):
+        if self._trace is not None:
+            self._trace.close()
+            self._trace = None
+
     def break_received(self, _):
         self.eof_received()
 
@@ -384,6 +653,7 @@ class MySSHSession(asyncssh.SSHServerSession):
 class MySSHServer(asyncssh.SSHServer):
     def connection_made(self, conn):
         self.conn = conn
+        CONNECTIONS.add(conn)
         self.conn_pass = get_random_password()
         conn.send_auth_banner(SSHTemplate.banner(self.conn_pass))
         log(
@@ -392,7 +662,7 @@ class MySSHServer(asyncssh.SSHServer):
         )
 
     def connection_lost(self, exc):
-        pass
+        CONNECTIONS.discard(self.conn)
 
     def password_auth_supported(self):
         return True
@@ -410,18 +680,61 @@ class MySSHServer(asyncssh.SSHServer):
 
 
 async def start_server():
+    """
+    Start serving, and return the servers and their listening sockets, by name
+    """
     port = int(os.environ.get("SSH_SERVER_PORT", 8022))
-    await asyncssh.create_server(
-        MySSHServer, "", port, server_host_keys=["key"], line_editor=True
-    )
+    sockets = {"SSH": listen_socket("SSH", port)}
+    # Frames are pre-encoded: use a binary channel
+    servers = [
+        await asyncssh.create_server(
+            MySSHServer,
+            sock=sockets["SSH"],
+            server_host_keys=["key"],
+            encoding=None,
+            line_editor=False,
+            **transport_options(),
+        )
+    ]
+
+    # Optional plain-text version, for curl
+    http_port = os.environ.get("HTTP_SERVER_PORT")
+    if http_port:
+        sockets["HTTP"] = listen_socket("HTTP", int(http_port))
+        servers.append(await start_http_server(PACKSDB, sock=sockets["HTTP"]))
+
+    return servers, sockets
+
+
+def main():
+    loop = asyncio.get_event_loop()
+
+    try:
+        servers, sockets = loop.run_until_complete(start_server())
+    except (OSError, ValueError, asyncssh.Error) as exc:
+        sys.exit("Error starting server: " + str(exc))
+
+    # Keep the "most viewed" order up to date
+    PACKSDB.start_views_refresh()
+
+    # Hand over to a new process on SIGUSR2. Views are saved a last time for it
+    # to load, and only it saves them from then on
+    Handover(
+        loop,
+        servers,
+        sockets,
+        CONNECTIONS,
+        before_restart=PACKSDB.stop_views_refresh,
+        restart_failed=PACKSDB.start_views_refresh,
+    ).install()
 
+    # Sample the server on SIGUSR1
+    LoopProfiler(loop).install()
 
-loop = asyncio.get_event_loop()
+    logging.info("Starting server as user %s", getpass.getuser())
+    notify_ready()
+    loop.run_forever()
 
-try:
-    loop.run_until_complete(start_server())
-except (OSError, asyncssh.Error) as exc:
-    sys.exit("Error starting server: " + str(exc))
 
-logging.info("Starting server as user %s", getpass.getuser())
-loop.run_forever()
+if __name__ == "__main__":
+    main()
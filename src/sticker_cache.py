@@ -0,0 +1,111 @@
+"""
+On-disk cache of the sticker images downloaded by `create_packsdata.py`, so
+that the archive can be rebuilt (eg. with another ASCII palette) offline.
+
+Images are stored once, by the SHA-256 of their content, in `blobs/`. For each
+pack, `packs/` holds the list of its stickers (id and image hash) and the hash
+of its cover. When the blobs take more than `max_size` bytes, the least
+recently used ones are evicted.
+"""
+import hashlib
+import json
+import os
+
+CACHE_DIR = os.environ.get("STICKERS_CACHE_DIR", "stickers_cache")
+CACHE_MAX_SIZE = int(os.environ.get("STICKERS_CACHE_MAX_SIZE", 2 * 1024 ** 3))
+
+# When evicting, go down to this fraction of max_size, to not evict on each put
+EVICT_TO = 0.9
+
+
+class StickerCache:
+    def __init__(self, path=CACHE_DIR, max_size=CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self._blobs_dir = os.path.join(path, "blobs")
+        self._packs_dir = os.path.join(path, "packs")
+        os.makedirs(self._blobs_dir, exist_ok=True)
+        os.makedirs(self._packs_dir, exist_ok=True)
+
+        self.size = sum(entry.stat().st_size for entry in os.scandir(self._blobs_dir))
+
+    def get_pack(self, pack_id, pack_key):
+        """
+        Return (cover, [(sticker_id, image), ...]) for a pack, or None if it is
+        not (or not completely) in the cache
+        """
+        try:
+            with open(self._pack_path(pack_id, pack_key)) as f_pack:
+                pack = json.load(f_pack)
+
+            cover = self._get_blob(pack["cover"])
+            stickers = [
+                (sticker_id, self._get_blob(digest))
+                for sticker_id, digest in pack["stickers"]
+            ]
+        except FileNotFoundError:
+            return None
+
+        return cover, stickers
+
+    def put_pack(self, pack_id, pack_key, cover, stickers):
+        """
+        Store the `cover` image and the `stickers` ([(sticker_id, image), ...])
+        of a pack
+        """
+        pack = {
+            "cover": self._put_blob(cover),
+            "stickers": [
+                (sticker_id, self._put_blob(image)) for sticker_id, image in stickers
+            ],
+        }
+        self._write(self._pack_path(pack_id, pack_key), json.dumps(pack).encode())
+
+        if self.size > self.max_size:
+            self.evict(int(self.max_size * EVICT_TO))
+
+    def evict(self, max_size):
+        """
+        Remove the least recently used images until they take at most
+        `max_size` bytes
+        """
+        blobs = sorted(
+            os.scandir(self._blobs_dir), key=lambda entry: entry.stat().st_mtime
+        )
+        for entry in blobs:
+            if self.size <= max_size:
+                break
+            self.size -= entry.stat().st_size
+            os.remove(entry.path)
+
+    def _pack_path(self, pack_id, pack_key):
+        # The key is part of the cache key, without being readable in clear
+        key_digest = hashlib.sha256(pack_key.encode()).hexdigest()[:16]
+        return os.path.join(self._packs_dir, f"{pack_id}-{key_digest}.json")
+
+    def _get_blob(self, digest):
+        path = os.path.join(self._blobs_dir, digest)
+        with open(path, "rb") as f_blob:
+            image = f_blob.read()
+        # Mark as recently used
+        os.utime(path)
+        return image
+
+    def _put_blob(self, image):
+        digest = hashlib.sha256(image).hexdigest()
+        path = os.path.join(self._blobs_dir, digest)
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            self._write(path, image)
+            self.size += len(image)
+        return digest
+
+    @staticmethod
+    def _write(path, content):
+        """
+        Write `content` to `path` atomically
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f_out:
+            f_out.write(content)
+        os.replace(tmp_path, path)
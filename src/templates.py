@@ -1,4 +1,7 @@
+from collections import OrderedDict
+import functools
 import math
+import re
 
 from utils import center_and_shorten_str
 
@@ -19,21 +22,112 @@ class SSHColors:
     EOL = "\033[0m\n"
 
 
+ANSI_ESCAPE = re.compile(rb"\033\[[0-9;]*m")
+
+
+# Pre-encoded fragments of the thumbnails, as the same ones are drawn over and
+# over. Indexed by `selected`
+_THUMB_COLOR = (
+    SSHColors.LIGHTGRAY,
+    f"{SSHColors.GREEN}{SSHColors.BOLD}",
+)
+_THUMB_BORDER_H = tuple(
+    f"{color}+{'-' * 15}+{SSHColors.ENDC}\n".encode() for color in _THUMB_COLOR
+)
+_THUMB_BORDER_V = tuple(f"{color}|{SSHColors.ENDC}".encode() for color in _THUMB_COLOR)
+_THUMB_NSFW = (
+    f"{' '*15}\n" * 3
+    + SSHColors.LIGHTGRAY
+    + f"{'This pack is':^15}\n"
+    + SSHColors.LIGHTGRAY
+    + f"{'NSFW':^15}\n"
+    + f"{' '*15}\n" * 3
+).encode()
+_LABEL_ORIGINAL = f"{SSHColors.BACKBLUE}Original{SSHColors.ENDC}".encode()
+_LABEL_ANIMATED = f"{SSHColors.BACKRED}Animated{SSHColors.ENDC}".encode()
+
+# Without colors, the selected thumbnail has its own borders
+_PLAIN_BORDER_H = (f"+{'-' * 15}+\n".encode(), f"#{'=' * 15}#\n".encode())
+_PLAIN_BORDER_V = (b"|", b"#")
+_PLAIN_NSFW = ANSI_ESCAPE.sub(b"", _THUMB_NSFW)
+
+# Number of searched terms rendered kept by each template
+SEARCHED_CACHE_SIZE = 64
+
+
 class SSHTemplate:
     """
-    Return strings ready to be returned to the user.
-    All functions return (outstring, nb_line_taken)
+    Return UTF-8 encoded bytes ready to be written to the user.
+    All functions return (outbytes, nb_line_taken)
+
+    Instances only depend on the terminal geometry and colors: use
+    `SSHTemplate.get()` to share them (and their static blocks) between
+    sessions.
     """
 
-    def __init__(self, term_width, term_height, nb_img_per_row):
+    __slots__ = (
+        "term_height",
+        "term_width",
+        "nb_img_per_row",
+        "color",
+        "_header",
+        "_intros",
+        "_help",
+        "_loading",
+        "_pads",
+        "_searched",
+    )
+
+    def __init__(self, term_width, term_height, nb_img_per_row, color=True):
         self.term_height = term_height
         self.term_width = term_width
         self.nb_img_per_row = nb_img_per_row
+        self.color = color
+
+        # Static blocks, rendered once per geometry
+        self._header = self._encode(self._make_header())
+        self._intros = {}
+        self._help = self._encode(self._make_help())
+        self._loading = self._encode(self._make_loading())
+        self._pads = {}
+        # Recently searched terms, as each keystroke of a search is one
+        self._searched = OrderedDict()
+
+    @classmethod
+    @functools.lru_cache(maxsize=64)
+    def get(cls, term_width, term_height, nb_img_per_row, color=True):
+        """
+        Return the shared instance for this terminal geometry
+        """
+        return cls(term_width, term_height, nb_img_per_row, color)
 
     def header(self):
         """
         Return the nice blue header at the top + offset
         """
+        return self._header
+
+    def intro(self, sort_label=None):
+        """
+        Return the few lines of intro, with the sort order if given, + offset
+        """
+        if sort_label not in self._intros:
+            self._intros[sort_label] = self._encode(self._make_intro(sort_label))
+        return self._intros[sort_label]
+
+    def help(self):
+        """
+        Return the help content + offset
+        """
+        return self._help
+
+    def loading(self):
+        """
+        Return the placeholder shown while a pack is loading + offset
+        """
+        return self._loading
+
+    def _make_header(self):
         outstr = SSHColors.BACKBLUE + " " * self.term_width + SSHColors.ENDC
         outstr += (
             SSHColors.BACKBLUE
@@ -47,17 +141,19 @@ class SSHTemplate:
 
         return outstr, 5
 
-    def intro(self):
-        """
-        Return the few lines of intro + offset
-        """
+    def _make_intro(self, sort_label):
         outstr = self._line_center(
             "Welcome to Signal Stickers, the unofficial directory for Signal sticker packs."
         )
         outstr += self._line_center(
             "Follow https://twitter.com/signalstickers to stay tuned for new packs!"
         )
-        outstr += self._line_center("Press h for help.")
+        if sort_label:
+            outstr += self._line_center(
+                f"Press h for help. Sorted by: {sort_label} (press o to change)."
+            )
+        else:
+            outstr += self._line_center("Press h for help.")
         outstr += self._line()
         outstr += self._line()
 
@@ -67,6 +163,16 @@ class SSHTemplate:
         """
         Return the text when the user searches a word + offset
         """
+        searched = self._searched.get(term)
+        if searched is None:
+            searched = self._searched[term] = self._make_searched_terms(term)
+            if len(self._searched) > SEARCHED_CACHE_SIZE:
+                self._searched.popitem(last=False)
+        else:
+            self._searched.move_to_end(term)
+        return searched
+
+    def _make_searched_terms(self, term):
         results_txt = f"Results for {SSHColors.BOLD}{term}{SSHColors.ENDC}"
         outstr = self._line_center("-" * 30)
         # Account for bold chars
@@ -75,12 +181,15 @@ class SSHTemplate:
         outstr += self._line_center("(press Esc to exit Search mode)")
         outstr += self._line()
         outstr += self._line()
-        return outstr, 6
+        return self._encode((outstr, 6))
 
-    def help(self):
-        """
-        Return the help content + offset
-        """
+    def _make_loading(self):
+        outstr = self._line()
+        outstr += self._line_center("Loading pack…")
+        outstr += self._line()
+        return outstr, 3
+
+    def _make_help(self):
         outstr = self._line()
         outstr += self._line_center_bold("HELP")
         outstr += self._line()
@@ -89,13 +198,18 @@ class SSHTemplate:
             "Use arrows or wasd to navigate around packs. Hit Return to select a pack."
         )
         outstr += self._line("To get back to pack list, press Esc.")
+        outstr += self._line(
+            "To sort packs by title, newest or most viewed first, press o."
+        )
         outstr += self._line("To exit, use Ctrl+C or close the window.")
         outstr += self._line()
         outstr += self._line_bold("Search")
         outstr += self._line(
-            "To search for a pack, use the / key, type your word, then press Return."
+            "To search for a pack, use the / key and type: results show as you type."
+        )
+        outstr += self._line(
+            'Press Return to browse the results. To exit "Search mode", press Esc.'
         )
-        outstr += self._line('To exit "Search mode", press the Esc key.')
         outstr += self._line()
         outstr += self._line_bold("About signalstickers")
         outstr += self._line(
@@ -120,7 +234,7 @@ class SSHTemplate:
         outstr += self._line()
         outstr += self._line_center_bold("Press Esc to go back to pack list.")
 
-        return outstr, 28
+        return outstr, 29
 
     def pad(self, offset):
         """
@@ -129,7 +243,9 @@ class SSHTemplate:
         # return (
         #     "\n".join([str(i) for i in range((self.term_height - offset))]) + "\n"
         # )  # Use this for padding debug
-        return "\n" * (self.term_height - offset)
+        if offset not in self._pads:
+            self._pads[offset] = b"\n" * (self.term_height - offset)
+        return self._pads[offset]
 
     def make_thumbnails_row(self, thumbnails, height=12):
         """
@@ -140,16 +256,69 @@ class SSHTemplate:
 
         thumbs_splitted = [t.splitlines() for t in thumbnails]
 
-        thumbs_row = ""
-
-        for i in range(0, height):
-            char_row = ""
+        # Each thumbnail line is surrounded by 2 spaces
+        return b"".join(
+            b"  " + b"    ".join([t[i] for t in thumbs_splitted]) + b"  \n"
+            for i in range(0, height)
+        )
 
-            for t in thumbs_splitted:
-                char_row += f"  {t[i]}  "
-            thumbs_row += char_row + "\n"
+    def packs_grid(self, packs, thumbs, cursor=None):
+        """
+        Return the covers of `packs`, the one at index `cursor` being selected,
+        + offset. `thumbs` maps thumbnail ids to ASCII images
+        """
+        thumbnails = [
+            self.create_thumbnail(
+                thumbs[pack["cover"]],
+                title=pack["title"],
+                selected=idx == cursor,
+                original=pack.get("original", False),
+                animated=pack.get("animated", False),
+                nsfw=pack.get("nsfw", False),
+                color=self.color,
+            )
+            for idx, pack in enumerate(packs)
+        ]
+        return self._grid(thumbnails, 12)  # height of a thumb with title
 
-        return thumbs_row
+    def packs_list(self, packs, cursor=None):
+        """
+        Return the titles of `packs`, in the columns of `packs_grid`, the one at
+        index `cursor` being selected, + offset
+        """
+        titles = [
+            (b"#%s#" if idx == cursor else b" %s ")
+            % center_and_shorten_str(pack["title"], 15, "…").encode()
+            for idx, pack in enumerate(packs)
+        ]
+        rows = [
+            b"  " + b"    ".join(titles[i : i + self.nb_img_per_row]) + b"  \n"
+            for i in range(0, len(titles), self.nb_img_per_row)
+        ]
+        # Each row is followed by an empty line
+        return b"\n".join(rows) + b"\n" if rows else b"", len(rows) * 2
+
+    def thumbs_grid(self, thumb_ids, thumbs):
+        """
+        Return the stickers of a pack + offset. `thumbs` maps thumbnail ids to
+        ASCII images (the "images" of the pack)
+        """
+        thumbnails = [
+            self.create_thumbnail(thumbs[thumb_id], color=self.color)
+            for thumb_id in thumb_ids
+        ]
+        return self._grid(thumbnails, 10)  # height of a thumb without title
+
+    def _grid(self, thumbnails, height):
+        rows = [
+            self.make_thumbnails_row(
+                thumbnails[i : i + self.nb_img_per_row],
+                height,
+            )
+            for i in range(0, len(thumbnails), self.nb_img_per_row)
+        ]
+        # Each row is followed by an empty line
+        return b"\n".join(rows) + b"\n" if rows else b"", len(rows) * (height + 1)
 
     def details(self, pack):
 
@@ -197,69 +366,90 @@ class SSHTemplate:
         if self.term_width < 146:
             offset += math.ceil(146 / self.term_width) - 1
 
-        return outstr, offset
+        return self._encode((outstr, offset))
 
     @staticmethod
+    @functools.lru_cache(maxsize=4096)
     def create_thumbnail(
-        image, title="", selected=False, original=False, animated=False, nsfw=False
+        image,
+        title="",
+        selected=False,
+        original=False,
+        animated=False,
+        nsfw=False,
+        color=True,
     ):
         """
-        Images must be 15px wide
+        Images must be 15px wide.
+        Thumbnails are cached, as the same ones are drawn on every keypress. As
+        each image is a single string (shared by all the packs using it for
+        covers, and by the loaded pack for stickers), cache lookups mostly
+        compare them by identity
         """
-        max_img_width = 15
-        color = (
-            f"{SSHColors.GREEN}{SSHColors.BOLD}" if selected else SSHColors.LIGHTGRAY
-        )
-
-        border_h = f"{color}+{'-' * max_img_width}+{SSHColors.ENDC}\n"
-
-        img_bordered = border_h
+        if color:
+            border_h = _THUMB_BORDER_H[selected]
+            border_v = _THUMB_BORDER_V[selected]
+        else:
+            border_h = _PLAIN_BORDER_H[selected]
+            border_v = _PLAIN_BORDER_V[selected]
 
         if nsfw:
             # Replace image with warning
-            image = (
-                f"{' '*15}\n" * 3
-                + SSHColors.LIGHTGRAY
-                + f"{'This pack is':^15}\n"
-                + SSHColors.LIGHTGRAY
-                + f"{'NSFW':^15}\n"
-                + f"{' '*15}\n" * 3
-            )
+            image_lines = (_THUMB_NSFW if color else _PLAIN_NSFW).splitlines()
+        else:
+            image_lines = image.encode().splitlines()
+
+        parts = [border_h]
+        for img_line in image_lines:
+            parts += (border_v, img_line, border_v, b"\n")
+        parts.append(border_h)
 
-        for img_line in image.splitlines():
-            img_bordered += (
-                f"{color}|{SSHColors.ENDC}{img_line}{color}|{SSHColors.ENDC}\n"
+        if title:
+            parts += (
+                border_v,
+                center_and_shorten_str(title, 15, "…").encode(),
+                border_v,
+                b"\n",
+                border_h,
             )
 
-        img_bordered += border_h
+        img_bordered = b"".join(parts)
+
+        # Labels are only drawn over ASCII chars, so positions are the same in
+        # bytes as in chars
+        if not color:
+            # Over the left border and the first chars of the 1st line, and the
+            # last chars and the right border of the 2nd line
+            if original:
+                img_bordered = img_bordered[:18] + b"Original" + img_bordered[26:]
+            if animated:
+                img_bordered = img_bordered[:45] + b"Animated" + img_bordered[53:]
+            return img_bordered
 
         if original:
-            label = f"{SSHColors.BACKBLUE}Original{SSHColors.ENDC}"
             start_pos = 31 if selected else 27
             end_pos = 52 if selected else 44
-            img_bordered = img_bordered[:start_pos] + label + img_bordered[end_pos:]
+            img_bordered = (
+                img_bordered[:start_pos] + _LABEL_ORIGINAL + img_bordered[end_pos:]
+            )
 
         if animated:
-            label = f"{SSHColors.BACKRED}Animated{SSHColors.ENDC}"
             start_pos = 93 if selected and original else 97 if selected else 81
             end_pos = 114 if selected and original else 118 if selected else 94
-            img_bordered = img_bordered[:start_pos] + label + img_bordered[end_pos:]
-
-        if title:
-
-            pack_title = (
-                f"{color}|{SSHColors.ENDC}"
-                + center_and_shorten_str(title, 15, "…")
-                + f"{color}|{SSHColors.ENDC}\n"
+            img_bordered = (
+                img_bordered[:start_pos] + _LABEL_ANIMATED + img_bordered[end_pos:]
             )
 
-            img_bordered += pack_title
-            img_bordered += border_h
-
         return img_bordered
 
     # Utils
 
+    def _encode(self, block):
+        outstr, offset = block
+        if self.color:
+            return outstr.encode(), offset
+        return ANSI_ESCAPE.sub(b"", outstr.encode()), offset
+
     def _line(self, content=""):
         return f"{content}\n"
 
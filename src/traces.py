@@ -0,0 +1,119 @@
+"""
+Record what users do in a session, to replay it later with `replay.py`.
+
+A trace is a JSON lines file, one event per line:
+
+    {"t": 0.0, "event": "start", "width": 120, "height": 40}
+    {"t": 1.42, "event": "key", "key": "\u001b[C"}
+    {"t": 3.07, "event": "resize", "width": 100, "height": 40}
+    {"t": 5.8, "event": "search", "term": "cat"}
+    {"t": 9.1, "event": "end"}
+
+`t` is the number of seconds since the session started. Keys are stored as
+latin-1 text, so that any byte sequence can be replayed as is. No pack content
+is recorded.
+
+Events are appended to the trace file by a background thread: a slow or failing
+disk does not hold the sessions up, failures are only logged.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import time
+import uuid
+
+# Set this to a folder to record the trace of every session
+TRACES_DIR = os.environ.get("SSH_TRACES_DIR")
+
+# Number of events kept in memory before being appended to the trace file
+FLUSH_EVERY = 64
+
+# Appends to the trace files, in order
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="traces")
+
+# Whether TRACES_DIR exists, once checked
+_dir_ready = None
+
+
+class TraceRecorder:
+
+    __slots__ = ("path", "_start", "_events")
+
+    def __init__(self, traces_dir):
+        self.path = os.path.join(
+            traces_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.jsonl"
+        )
+        self._start = time.monotonic()
+        self._events = []
+
+    @classmethod
+    def create(cls):
+        """
+        Return a recorder if traces are enabled (and their folder can be
+        created), else None
+        """
+        global _dir_ready
+        if not TRACES_DIR:
+            return None
+
+        if _dir_ready is None:
+            try:
+                os.makedirs(TRACES_DIR, exist_ok=True)
+                _dir_ready = True
+            except OSError:
+                logging.exception("Could not create the traces folder")
+                _dir_ready = False
+        return cls(TRACES_DIR) if _dir_ready else None
+
+    def record(self, event, **fields):
+        self._events.append(
+            {"t": round(time.monotonic() - self._start, 4), "event": event, **fields}
+        )
+
+        if len(self._events) >= FLUSH_EVERY:
+            self.flush()
+
+    def key(self, data):
+        self.record("key", key=data.decode("latin-1"))
+
+    def flush(self):
+        if not self._events:
+            return
+
+        lines = "".join(
+            json.dumps(event, separators=(",", ":")) + "\n" for event in self._events
+        )
+        self._events.clear()
+        _writer.submit(_append, self.path, lines)
+
+    def close(self):
+        self.record("end")
+        self.flush()
+
+
+def _append(path, lines):
+    try:
+        with open(path, "a") as f_trace:
+            f_trace.write(lines)
+    except OSError:
+        logging.exception("Could not write the trace %s", path)
+
+
+def read_trace(path):
+    """
+    Return the events of a trace file. A last line cut short (the server
+    stopped while writing it) is skipped
+    """
+    with open(path) as f_trace:
+        lines = [line for line in f_trace if line.strip()]
+
+    events = []
+    for idx, line in enumerate(lines):
+        try:
+            events.append(json.loads(line))
+        except json.JSONDecodeError:
+            if idx == len(lines) - 1:
+                break
+            raise ValueError(f"invalid event on line {idx + 1}") from None
+    return events
@@ -0,0 +1,71 @@
+"""
+SSH transport settings of the server, picked with `SSH_TRANSPORT_PROFILE`:
+
+- "default": the asyncssh defaults (post-quantum hybrid key exchange first,
+  compression if the client asks for it)
+- "fast": cheap key exchange (curve25519) and AES-GCM first, for bursts of
+  new connections
+- "compressed": "fast", with compression required. Frames are ANSI text and
+  compress well, but clients without zlib support can not connect
+
+Sessions only receive keystrokes: all profiles but "default" advertise a small
+receive window and packet size, which bounds what a client can make the server
+buffer. Compare the profiles with `bench_transport.py`.
+"""
+import os
+
+FAST_KEX = [
+    "curve25519-sha256",
+    "curve25519-sha256@libssh.org",
+    "ecdh-sha2-nistp256",
+    "diffie-hellman-group14-sha256",
+]
+FAST_ENCRYPTION = [
+    "aes128-gcm@openssh.com",
+    "chacha20-poly1305@openssh.com",
+    "aes128-ctr",
+]
+FAST_MAC = [
+    "umac-64-etm@openssh.com",
+    "hmac-sha2-256-etm@openssh.com",
+    "hmac-sha2-256",
+]
+
+RECEIVE_WINDOW = 64 * 1024
+RECEIVE_MAX_PKTSIZE = 16 * 1024
+
+PROFILES = {
+    "default": {},
+    "fast": {
+        "kex_algs": FAST_KEX,
+        "encryption_algs": FAST_ENCRYPTION,
+        "mac_algs": FAST_MAC,
+        "window": RECEIVE_WINDOW,
+        "max_pktsize": RECEIVE_MAX_PKTSIZE,
+    },
+    "compressed": {
+        "kex_algs": FAST_KEX,
+        "encryption_algs": FAST_ENCRYPTION,
+        "mac_algs": FAST_MAC,
+        # Delayed compression (after authentication) first
+        "compression_algs": ["zlib@openssh.com", "zlib"],
+        "window": RECEIVE_WINDOW,
+        "max_pktsize": RECEIVE_MAX_PKTSIZE,
+    },
+}
+
+
+def transport_options(profile=None):
+    """
+    Return the `asyncssh.create_server()` options of `profile`, by default the
+    one set in `SSH_TRANSPORT_PROFILE`
+    """
+    if profile is None:
+        profile = os.environ.get("SSH_TRANSPORT_PROFILE", "default")
+
+    try:
+        return dict(PROFILES[profile])
+    except KeyError:
+        raise ValueError(
+            f"Unknown transport profile {profile!r}, use one of {', '.join(PROFILES)}"
+        ) from None
@@ -1,8 +1,45 @@
+import asyncio
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import json
+import logging
+import os
 import random
+import string
+import sys
+import threading
 import unicodedata
 import zipfile
 
+from pack_index import PackIndex, make_ranks
+
+# Number of threads loading packs off the event loop
+LOAD_WORKERS = int(os.environ.get("PACKS_LOAD_WORKERS", 4))
+
+# Number of loaded packs kept in memory
+CACHE_SIZE = int(os.environ.get("PACKS_CACHE_SIZE", 256))
+
+# Number of threads making the speculative pack loads. They have their own
+# threads, so that loads asked for by users never wait behind them
+PREFETCH_WORKERS = int(os.environ.get("PACKS_PREFETCH_WORKERS", 1))
+
+# Number of speculative pack loads queued or running at once, for all sessions
+PREFETCH_BUDGET = int(os.environ.get("PACKS_PREFETCH_BUDGET", 2))
+
+# Where the number of views of each pack is saved
+VIEWS_PATH = os.environ.get("PACKS_VIEWS_PATH", "views.json")
+
+# Seconds between two updates of the "most viewed" order
+VIEWS_REFRESH = float(os.environ.get("PACKS_VIEWS_REFRESH", 300))
+
+# Chars allowed in a search
+printable = (string.ascii_letters + string.digits + string.punctuation + " ").encode()
+
+# Max number of chars of a search
+SEARCH_MAX_LENGTH = 64
+
 
 def get_random_password():
     return random.choice([
@@ -21,26 +58,343 @@ def get_random_password():
     ]) + str(random.randrange(1, 100))
 
 
+def clean_search_term(term):
+    """
+    Return `term` without the chars that can not be typed in a search (eg.
+    terminal escapes), cut to `SEARCH_MAX_LENGTH`
+    """
+    chars = printable.decode()
+    return "".join(char for char in term if char in chars)[:SEARCH_MAX_LENGTH]
+
+
+def thumb_id(image):
+    """
+    Return the content id of an ASCII thumbnail
+    """
+    return hashlib.sha1(image.encode()).hexdigest()[:16]
+
+
 class PacksDB:
-    def __init__(self, zip_path):
+    def __init__(self, zip_path, load_workers=LOAD_WORKERS):
+        self.zip_path = zip_path
         self.f_zip = zipfile.ZipFile(zip_path)
-        self.index = self.get("packsinfo")
+
+        # Packs are inflated and parsed by these workers. A ZipFile can not be
+        # read by several threads at once, so each worker opens its own
+        self._executor = ThreadPoolExecutor(
+            max_workers=load_workers, thread_name_prefix="packsdb"
+        )
+        self._prefetch_executor = ThreadPoolExecutor(
+            max_workers=PREFETCH_WORKERS, thread_name_prefix="packsdb-prefetch"
+        )
+        # The "most viewed" order is sorted there, not to delay pack loads
+        self._views_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="packsdb-views"
+        )
+        self._worker_local = threading.local()
+        # Packs being loaded, by id
+        self._loading = {}
+        # Number of sessions waiting for each pack being loaded only
+        # speculatively, by id
+        self._prefetching = {}
+        # Speculative loads queued or running in the workers. A load keeps
+        # running once started, even if its prefetch is cancelled
+        self._prefetch_futures = set()
+        # Recently loaded packs, by id
+        self._cache = OrderedDict()
+
+        # ASCII thumbnails of the covers of the index, by id. Ids are interned,
+        # to be shared with the index. Sticker thumbnails are only read with
+        # their pack, see `_resolve_thumbs()`
+        self.thumbs = {}
+        if "thumbs.json" in self.f_zip.namelist():
+            self.thumbs = {
+                sys.intern(ref): thumb for ref, thumb in self._load("thumbs").items()
+            }
+
+        self.index = PackIndex(self._load("packsinfo"), self._thumb_ref)
+        # Only covers stay in memory, whatever the table of the archive holds
+        self.thumbs = {ref: self.thumbs[ref] for ref in self.index.cover_ids}
+
+        # What searches are matched against, for each pack of the index. Title
+        # and tags are separated by a char that can not be searched
+        self.search_keys = [
+            title.lower() + "\n" + tags
+            for title, tags in zip(self.index.titles, self.index.tags)
+        ]
+
+        # Number of views of each pack, by position in the index
+        self.views = array("I", [0]) * len(self.index)
+        self._load_views()
+        # Task updating the "most viewed" order, see `start_views_refresh()`
+        self._views_refresh = None
+        # Held while the views are written. Once they are handed to another
+        # process, they are not written anymore
+        self._views_lock = threading.Lock()
+        self._views_handed_over = False
+
+    def record_view(self, pack):
+        """
+        Count a view of `pack`, a record of the index
+        """
+        self.views[pack.position] += 1
+
+    def start_views_refresh(self):
+        """
+        Sort the packs by views and save the views, every `VIEWS_REFRESH`
+        seconds, until `stop_views_refresh()`
+        """
+        self._views_handed_over = False
+        self._views_refresh = asyncio.ensure_future(self._refresh_views())
+
+    def stop_views_refresh(self):
+        """
+        Stop updating the views, and save them a last time, for a new process to
+        load. Sorts still running in a worker do not save them anymore. This
+        blocks
+        """
+        if self._views_refresh is not None:
+            self._views_refresh.cancel()
+            self._views_refresh = None
+        with self._views_lock:
+            self._write_views(self.views)
+            self._views_handed_over = True
+
+    async def _refresh_views(self):
+        """
+        Update the "most viewed" order. Sessions get it when they change their
+        sort
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(VIEWS_REFRESH)
+            # Counted on, while sorted by a worker
+            views = array("I", self.views)
+            try:
+                order, ranks = await loop.run_in_executor(
+                    self._views_executor, self._sort_views, views
+                )
+            except Exception:
+                logging.exception("Could not update the views")
+                continue
+            self.index.set_order("views", order, ranks)
+
+    def save_views(self, views=None):
+        """
+        Write the number of views of each pack (`self.views` by default) to
+        `VIEWS_PATH`, unless they were handed to a new process. This blocks
+        """
+        if views is None:
+            views = self.views
+        with self._views_lock:
+            if not self._views_handed_over:
+                self._write_views(views)
+
+    def _write_views(self, views):
+        views = {id: count for id, count in zip(self.index.ids, views) if count}
+        tmp_path = f"{VIEWS_PATH}.tmp"
+        with open(tmp_path, "w") as f_out:
+            json.dump(views, f_out)
+        os.replace(tmp_path, VIEWS_PATH)
+
+    def _load_views(self):
+        try:
+            with open(VIEWS_PATH) as f_in:
+                views = json.load(f_in)
+        except FileNotFoundError:
+            return
+
+        for pos, id in enumerate(self.index.ids):
+            self.views[pos] = views.get(id, 0)
+        self.index.set_order("views", *self._sort_views(self.views, save=False))
+
+    def _sort_views(self, views, save=True):
+        """
+        Return the positions of the packs by decreasing views, and their ranks
+        """
+        if save:
+            self.save_views(views)
+        # Ties stay in the default order
+        order = array(
+            "I", sorted(range(len(views)), key=views.__getitem__, reverse=True)
+        )
+        return order, make_ranks(order)
 
     def get(self, id):
-        with self.f_zip.open(f"{id}.json") as f_in:
+        """
+        Return the pack `id`. This blocks: use `load()` from the event loop
+        """
+        return self._resolve_thumbs(self._load(id))
+
+    def cached(self, id):
+        """
+        Return the pack `id` if it is in memory, else None
+        """
+        pack = self._cache.get(id)
+        if pack is not None:
+            self._cache.move_to_end(id)
+        return pack
+
+    async def load(self, id):
+        """
+        Return the pack `id`, loaded by a worker thread. Concurrent loads of the
+        same pack are made once
+        """
+        pack = self.cached(id)
+        if pack is not None:
+            return pack
+
+        self._prefetching.pop(id, None)
+        # One of the callers being cancelled must not cancel the others
+        return await asyncio.shield(self._load_task(id))
+
+    def prefetch(self, id):
+        """
+        Start loading the pack `id` if it is not already, and if the prefetch
+        budget allows it. Return whether the call was counted, in which case it
+        must be undone by a `cancel_prefetch()`
+        """
+        if id in self._prefetching:
+            self._prefetching[id] += 1
+            return True
+        if (
+            id in self._cache
+            or id in self._loading
+            or len(self._prefetch_futures) >= PREFETCH_BUDGET
+        ):
+            return False
+
+        future = self._prefetch_executor.submit(self._load_in_worker, id)
+        self._prefetch_futures.add(future)
+        future.add_done_callback(self._prefetch_futures.discard)
+
+        self._prefetching[id] = 1
+        self._load_task(id, future).add_done_callback(
+            lambda task: self._prefetch_done(id, task)
+        )
+        return True
+
+    def _prefetch_done(self, id, task):
+        self._prefetching.pop(id, None)
+        # Nobody may be waiting for this pack: retrieve the error, if any
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning("Could not prefetch pack %s: %r", id, task.exception())
+
+    def cancel_prefetch(self, id):
+        """
+        Cancel a prefetch of the pack `id`, once no session waits for it, and
+        unless it has been asked for with `load()` since
+        """
+        if id not in self._prefetching:
+            return
+        self._prefetching[id] -= 1
+        if not self._prefetching[id]:
+            del self._prefetching[id]
+            self._loading[id].cancel()
+
+    def _load_task(self, id, future=None):
+        """
+        Return the task loading the pack `id`, from `future` (a load submitted to
+        a worker) if given
+        """
+        task = self._loading.get(id)
+        if task is None:
+            if future is None:
+                future = self._executor.submit(self._load_in_worker, id)
+            task = self._loading[id] = asyncio.ensure_future(
+                self._load_async(id, future)
+            )
+            task.add_done_callback(lambda task: self._load_done(id, task, future))
+        return task
+
+    def _load_done(self, id, task, future):
+        self._loading.pop(id, None)
+        if task.cancelled():
+            # Drop the load if no worker has started it
+            future.cancel()
+
+    async def _load_async(self, id, future):
+        pack = await asyncio.wrap_future(future)
+
+        self._cache[id] = pack
+        if len(self._cache) > CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return pack
+
+    def _load_in_worker(self, name):
+        f_zip = getattr(self._worker_local, "f_zip", None)
+        if f_zip is None:
+            f_zip = self._worker_local.f_zip = zipfile.ZipFile(self.zip_path)
+
+        with f_zip.open(f"{name}.json") as f_in:
+            return self._resolve_thumbs(json.load(f_in))
+
+    def _load(self, name):
+        with self.f_zip.open(f"{name}.json") as f_in:
             return json.load(f_in)
 
+    def _resolve_thumbs(self, pack):
+        """
+        Set the "thumbs" of `pack` to the ids of its stickers, and its "images"
+        to their thumbnails, by id. Packs store the thumbnails of their
+        stickers, but the ones that also are a cover, which are in the covers
+        table. Archives made before thumbnails were deduplicated store images
+        inline. Run by the workers: the covers table is only read
+        """
+        images = pack.get("images", {})
+        refs = []
+        for thumb in pack["thumbs"]:
+            if "\n" in thumb:
+                ref = thumb_id(thumb)
+                images.setdefault(ref, thumb)
+            else:
+                ref = thumb
+                if ref not in images:
+                    images[ref] = self.thumbs[ref]
+            refs.append(ref)
+
+        pack["thumbs"] = refs
+        pack["images"] = images
+        return pack
+
+    def _thumb_ref(self, thumb):
+        """
+        Return the id of the cover `thumb`. Archives made before thumbnails
+        were deduplicated store images inline: move them to the table
+        """
+        if "\n" not in thumb:
+            return sys.intern(thumb)
+
+        ref = sys.intern(thumb_id(thumb))
+        self.thumbs.setdefault(ref, thumb)
+        return ref
+
 
 class Pager:
 
-    def __init__(self, page_size, packsdb_inst):
+    __slots__ = (
+        "_packsdb",
+        "page_size",
+        "_packs",
+        "page_idx",
+        "_cur_page",
+        "_cur_page_len",
+        "search_mode",
+        "_search",
+        "_matches",
+        "_sorted_matches",
+        "sort_order",
+    )
+
+    def __init__(self, page_size, packsdb_inst, sort_order="default"):
         self._packsdb = packsdb_inst
         self.page_size = page_size
-        self._all_packs_paginated = [self._packsdb.index[i:i+self.page_size]
-                                     for i in range(0, len(self._packsdb.index), self.page_size)]
+        self.sort_order = sort_order
 
-        # This contains the list of all packs for the current mode (all or search mode)
-        self._packs = self._all_packs_paginated
+        # This contains the flat list of all packs for the current mode (all or
+        # search mode). Pages are sliced from it on demand, so changing
+        # `page_size` never has to re-slice the whole catalog
+        self._packs = self._packsdb.index.ordered(sort_order)
 
         # Values depending on the current page
         self.page_idx = 0
@@ -49,50 +403,99 @@ class Pager:
         self._update_page()
 
         self.search_mode = False
+        self._search = None
+        # Positions of the packs matching the search, in the default order
+        self._matches = None
+        # `_matches` sorted, by sort order
+        self._sorted_matches = {}
 
     def details(self, pack):
         # For now, only show 1st page of stickers
-        self._packs = pack["thumbs"][:self.page_size]
-        # Do not call _update_page(), as this would mess up with page.idx
-        self._cur_page = self._packs 
+        # Do not touch self._packs or call _update_page(), as this would mess
+        # up with page.idx
+        self._cur_page = pack["thumbs"][:self.page_size]
         self._cur_page_len = len(self._cur_page)
 
     def exit_details(self):
         """
         Exit details mode
         """
-        self._packs = self._all_packs_paginated
         self._update_page()
 
     def search(self, term):
         self.search_mode = True
-        term = term.lower().lstrip()
-        matching_packs = []
-        for pack in self._packsdb.index:
-            if term in pack["title"].lower() or term in pack.get("tags", ""):
-                matching_packs.append(pack)
-
-        self._packs = [matching_packs[i:i+self.page_size]
-                       for i in range(0, len(matching_packs), self.page_size)]
-        self.page_idx = 0
-        self._update_page()
+        if self._search is None:
+            self._search = IncrementalSearch(self._packsdb.search_keys)
 
+        matches = self._search.search(term.lower().lstrip())
+        if matches is not self._matches:
+            self._matches = matches
+            self._sorted_matches = {}
+        self._list()
+
+    def validate_search(self):
+        """
+        Stop typing the search: only its results are kept, the next search
+        starts over
+        """
+        self._search = None
 
     def exit_search(self):
         """
         Exit search mode
         """
         self.search_mode = False
-        self._packs = self._all_packs_paginated
+        self._search = None
+        self._matches = None
+        self._sorted_matches = {}
+        self._list()
+
+    def sort(self, sort_order):
+        """
+        List the packs (or the search results) by `sort_order`, from the first
+        page
+        """
+        self.sort_order = sort_order
+        self._list()
+
+    def _list(self):
+        index = self._packsdb.index
+        if self._matches is None:
+            self._packs = index.ordered(self.sort_order)
+        else:
+            matches = self._sorted_matches.get(self.sort_order)
+            if matches is None:
+                matches = self._sorted_matches[self.sort_order] = index.sort(
+                    self._matches, self.sort_order
+                )
+            self._packs = index.view(matches)
         self.page_idx = 0
         self._update_page()
 
+    def position(self, cursor):
+        """
+        Return the absolute index of the pack at `cursor` in the current page
+        """
+        return self.page_idx * self.page_size + cursor
+
+    def resize(self, page_size, position=0):
+        """
+        Change the page size, and move to the page holding the pack at the
+        absolute `position`. Return the new cursor, relative to this page
+        """
+        self.page_size = page_size
+        position = min(position, max(len(self._packs) - 1, 0))
+        self.page_idx, cursor = divmod(position, self.page_size)
+        self._update_page()
+        return cursor
+
     def _update_page(self):
         """
         Update internal data with the current `page_idx`
         """
-        self._cur_page = self._packs[self.page_idx] if self._packs else [
-        ]  # in case of empty results
+        start = self.page_idx * self.page_size
+        # Empty in case of empty results
+        self._cur_page = self._packs[start:start + self.page_size]
         self._cur_page_len = len(self._cur_page)
 
     def next(self):
@@ -107,12 +510,21 @@ class Pager:
 
     @property
     def has_next(self):
-        return self.page_idx < len(self._packs) - 1
+        return (self.page_idx + 1) * self.page_size < len(self._packs)
 
     @property
     def has_prev(self):
         return self.page_idx > 0
 
+    def peek_next(self):
+        """
+        Return content for the next page, without moving to it
+        """
+        if not self.has_next:
+            return []
+        start = (self.page_idx + 1) * self.page_size
+        return self._packs[start:start + self.page_size]
+
     def __len__(self):
         """
         Return the length of the current page
@@ -127,6 +539,79 @@ class Pager:
         return self._cur_page
 
 
+class IncrementalSearch:
+    """
+    Search terms typed one char at a time. A term extending the previous one
+    can only match packs the previous one matched: keep the results of each
+    prefix, and only scan those
+    """
+
+    __slots__ = ("_keys", "_results")
+
+    def __init__(self, keys):
+        self._keys = keys
+        # (term, positions of the matching packs), from the shortest term. The
+        # empty term matches everything
+        self._results = [("", range(len(keys)))]
+
+    def search(self, term):
+        """
+        Return the positions of the packs matching `term`
+        """
+        # Go back to the longest search that is a prefix of `term`
+        while not term.startswith(self._results[-1][0]):
+            self._results.pop()
+
+        prefix, candidates = self._results[-1]
+        if term == prefix:
+            return candidates
+
+        keys = self._keys
+        matches = array("I", [i for i in candidates if term in keys[i]])
+        self._results.append((term, matches))
+        return matches
+
+
+class Debouncer:
+    """
+    Collapse bursts of calls into a single call of `callback`, `delay` seconds
+    after the last one
+    """
+
+    __slots__ = ("delay", "_callback", "_handle")
+
+    def __init__(self, delay, callback):
+        self.delay = delay
+        self._callback = callback
+        self._handle = None
+
+    def __call__(self):
+        self.cancel()
+        self._handle = asyncio.get_event_loop().call_later(self.delay, self._fire)
+
+    @property
+    def pending(self):
+        return self._handle is not None
+
+    def cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def flush(self, idle=None):
+        """
+        Run the pending call now, if any. If `idle` is given, only run it if it
+        would have fired after `idle` seconds
+        """
+        if self._handle is not None and (idle is None or idle >= self.delay):
+            self.cancel()
+            self._fire()
+
+    def _fire(self):
+        self._handle = None
+        self._callback()
+
+
 def center_and_shorten_str(string, width, placeholder="…"):
     """
     Center (and shorten if applicable) a string, handling CJK characters